@@ -0,0 +1,147 @@
+import datetime
+import decimal
+import gzip
+import json
+from sqlalchemy import select
+from src.models.user import db, Budget, Expense, Credit, BudgetYearArchive, ArchivedBudgetTotal
+from src.jobs import job_handler
+
+ARCHIVE_ENTRY_TYPES = {"expense": Expense, "credit": Credit}
+DATE_COLUMNS = {"expense_date", "credit_date"}
+DATETIME_COLUMNS = {"created_at", "updated_at"}
+
+class ArchiveConflict(Exception):
+    """Raised when archived rows cannot go back because their ids are taken by live rows."""
+
+def _encode_row(entry_type, row):
+    record = {"type": entry_type}
+    for key, value in row.items():
+        if isinstance(value, (datetime.date, datetime.datetime)):
+            value = value.isoformat()
+        elif isinstance(value, decimal.Decimal):
+            value = str(value)
+        record[key] = value
+    return record
+
+def _decode_record(record):
+    row = {key: value for key, value in record.items() if key != "type"}
+    for key in DATE_COLUMNS & row.keys():
+        row[key] = datetime.date.fromisoformat(row[key])
+    for key in DATETIME_COLUMNS & row.keys():
+        row[key] = datetime.datetime.fromisoformat(row[key]) if row[key] else None
+    row["amount"] = decimal.Decimal(row["amount"])
+    return row
+
+def _read_records(archive):
+    return [json.loads(line) for line in gzip.decompress(archive.data).splitlines() if line]
+
+def _write_records(records):
+    lines = "\n".join(json.dumps(record, separators=(",", ":")) for record in records)
+    return gzip.compress(lines.encode("utf-8"))
+
+def _family_year_budget_ids(family_id, year):
+    return list(db.session.scalars(select(Budget.id).where(Budget.family_id == family_id, Budget.year == year)))
+
+def _rebuild_totals(budget_ids, records):
+    db.session.query(ArchivedBudgetTotal).filter(ArchivedBudgetTotal.budget_id.in_(budget_ids)).delete(synchronize_session=False)
+    totals = {}
+    for record in records:
+        key = (record["budget_id"], record["type"], record.get("category_id"), record.get("subcategory_id"))
+        amount, count = totals.get(key, (decimal.Decimal(0), 0))
+        totals[key] = (amount + decimal.Decimal(record["amount"]), count + 1)
+    db.session.add_all([
+        ArchivedBudgetTotal(budget_id=budget_id, entry_type=entry_type, category_id=category_id,
+                            subcategory_id=subcategory_id, total_amount=amount, entry_count=count)
+        for (budget_id, entry_type, category_id, subcategory_id), (amount, count) in totals.items()
+    ])
+
+def check_archivable_year(year):
+    """Raise ValueError unless year is closed."""
+    if year >= datetime.date.today().year:
+        raise ValueError("Only closed years can be archived")
+
+def archive_family_year(family_id, year):
+    """Move a closed year's expenses and credits into its compressed archive.
+
+    Rows added to the year after an earlier archive run are merged into the existing
+    blob. Runs in the caller's transaction; the caller commits.
+    """
+    check_archivable_year(year)
+
+    budget_ids = _family_year_budget_ids(family_id, year)
+    archive = BudgetYearArchive.query.filter_by(family_id=family_id, year=year).first()
+    records = _read_records(archive) if archive else []
+
+    moved = {}
+    for entry_type, model in ARCHIVE_ENTRY_TYPES.items():
+        rows = db.session.execute(select(model.__table__).where(model.budget_id.in_(budget_ids))
+                                  .order_by(model.id)).mappings().all()
+        records.extend(_encode_row(entry_type, row) for row in rows)
+        moved[entry_type] = len(rows)
+
+    if not records:
+        return None
+
+    if not archive:
+        archive = BudgetYearArchive(family_id=family_id, year=year)
+        db.session.add(archive)
+    archive.data = _write_records(records)
+    archive.expense_count = sum(1 for record in records if record["type"] == "expense")
+    archive.credit_count = len(records) - archive.expense_count
+    _rebuild_totals(budget_ids, records)
+
+    for model in ARCHIVE_ENTRY_TYPES.values():
+        db.session.query(model).filter(model.budget_id.in_(budget_ids)).delete(synchronize_session=False)
+    return {"year": year, "archived_expenses": moved["expense"], "archived_credits": moved["credit"]}
+
+def restore_family_year(family_id, year):
+    """Put an archived year's rows back into the hot tables with their original ids.
+
+    Raises ArchiveConflict, before writing anything, if one of those ids is in use again.
+    """
+    archive = BudgetYearArchive.query.filter_by(family_id=family_id, year=year).first()
+    if not archive:
+        return None
+
+    records = _read_records(archive)
+    rows_by_model = {model: [_decode_record(record) for record in records if record["type"] == entry_type]
+                     for entry_type, model in ARCHIVE_ENTRY_TYPES.items()}
+    for model, rows in rows_by_model.items():
+        ids = [row["id"] for row in rows]
+        for start in range(0, len(ids), 1000):
+            taken = db.session.scalars(select(model.id).where(model.id.in_(ids[start:start + 1000])).limit(5)).all()
+            if taken:
+                raise ArchiveConflict(f"{model.__tablename__} ids {taken} of {year} are in use by other rows")
+    for model, rows in rows_by_model.items():
+        if rows:
+            db.session.execute(model.__table__.insert(), rows)
+
+    budget_ids = _family_year_budget_ids(family_id, year)
+    db.session.query(ArchivedBudgetTotal).filter(ArchivedBudgetTotal.budget_id.in_(budget_ids)).delete(synchronize_session=False)
+    db.session.delete(archive)
+    return {"year": year, "restored_expenses": archive.expense_count, "restored_credits": archive.credit_count}
+
+def iter_family_year_records(family_id, year):
+    """Yield expense and credit rows of a family-year as dicts, from the archive or the hot tables.
+
+    Exports go through here so they do not need to know whether a year was archived.
+    """
+    archive = BudgetYearArchive.query.filter_by(family_id=family_id, year=year).first()
+    if archive:
+        for record in _read_records(archive):
+            yield record["type"], _decode_record(record)
+    budget_ids = _family_year_budget_ids(family_id, year)
+    for entry_type, model in ARCHIVE_ENTRY_TYPES.items():
+        rows = db.session.execute(select(model.__table__).where(model.budget_id.in_(budget_ids))
+                                  .order_by(model.id)).mappings()
+        for row in rows:
+            yield entry_type, dict(row)
+
+def _archive_year_params(params):
+    year = int(params["year"])
+    check_archivable_year(year)
+    return {"year": year}
+
+@job_handler("archive_year", public_params=_archive_year_params)
+def _archive_year_job(context, year):
+    return archive_family_year(context.family_id, int(year)) or {"year": year, "archived_expenses": 0, "archived_credits": 0}
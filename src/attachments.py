@@ -0,0 +1,184 @@
+"""Content-addressed file store for expense receipts.
+
+Files are stored once under their SHA-256 (blobs/ab/cd/abcd...), so the same receipt
+uploaded twice takes the disk space of one; the database only keeps ExpenseAttachment
+metadata rows pointing at them. Unreferenced files are removed by the nightly sweep.
+"""
+import datetime
+import hashlib
+import os
+import re
+import tempfile
+from flask import current_app
+from sqlalchemy import select
+from src.models.user import db, ExpenseAttachment
+from src.jobs import job_handler
+
+try:
+    from PIL import Image
+except ImportError: # Thumbnails are disabled without Pillow
+    Image = None
+
+CHUNK_SIZE = 64 * 1024
+MAX_ATTACHMENT_SIZE = 20 * 1024 * 1024
+THUMBNAIL_SIZE = (320, 320)
+THUMBNAIL_CONTENT_TYPES = {"image/jpeg", "image/png", "image/gif", "image/webp"}
+# A thumbnail job still queued after this long means no job worker is running
+THUMBNAIL_QUEUE_TIMEOUT = datetime.timedelta(minutes=5)
+# The only names the store accepts; anything else could walk out of ATTACHMENT_DIR
+SHA256_PATTERN = re.compile(r"[0-9a-f]{64}")
+# Blobs touched more recently than this are left alone by the sweep, an upload may be about to reference them
+SWEEP_MIN_AGE = datetime.timedelta(days=1)
+
+def _root():
+    return current_app.config["ATTACHMENT_DIR"]
+
+def _sharded(directory, sha256, suffix=""):
+    if not isinstance(sha256, str) or not SHA256_PATTERN.fullmatch(sha256):
+        raise ValueError(f"Invalid attachment hash: {sha256!r}")
+    return os.path.join(_root(), directory, sha256[:2], sha256[2:4], sha256 + suffix)
+
+def blob_path(sha256):
+    return _sharded("blobs", sha256)
+
+def thumbnail_path(sha256):
+    return _sharded("thumbnails", sha256, ".jpg")
+
+def sniff_content_type(head):
+    """Content type from the file's magic bytes; the client's Content-Type is not trusted."""
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head.startswith(b"GIF8"):
+        return "image/gif"
+    if head.startswith(b"RIFF") and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head.startswith(b"%PDF-"):
+        return "application/pdf"
+    return None
+
+def has_thumbnail(content_type):
+    return Image is not None and content_type in THUMBNAIL_CONTENT_TYPES
+
+def thumbnail_supported(content_type):
+    return content_type in THUMBNAIL_CONTENT_TYPES
+
+def thumbnails_enabled():
+    return Image is not None
+
+def _replace_into(tmp_path, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(tmp_path, path) # Atomic: readers never see a partial file
+
+def store_stream(stream, max_size=MAX_ATTACHMENT_SIZE):
+    """Copy an upload into the store chunk by chunk, hashing on the way.
+
+    Returns (sha256, size, content_type). Raises ValueError for empty, oversized or
+    unsupported files, in which case nothing is kept.
+    """
+    tmp_dir = os.path.join(_root(), "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    head = b""
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+    try:
+        with os.fdopen(fd, "wb") as tmp:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_size:
+                    raise ValueError(f"Attachments are limited to {max_size // (1024 * 1024)} MB")
+                if len(head) < 16:
+                    head = (head + chunk)[:16]
+                digest.update(chunk)
+                tmp.write(chunk)
+
+        if not size:
+            raise ValueError("Empty upload")
+        content_type = sniff_content_type(head)
+        if not content_type:
+            raise ValueError("Only JPEG, PNG, GIF, WebP and PDF receipts are accepted")
+
+        sha256 = digest.hexdigest()
+        path = blob_path(sha256)
+        try:
+            os.utime(path) # Already stored; refreshing mtime keeps the sweep off it
+        except FileNotFoundError:
+            _replace_into(tmp_path, path)
+            tmp_path = None
+        return sha256, size, content_type
+    finally:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def make_thumbnail(sha256):
+    """Render the cached JPEG thumbnail of a stored image once; later calls are no-ops."""
+    path = thumbnail_path(sha256)
+    if os.path.exists(path):
+        return path
+    if Image is None:
+        raise RuntimeError("Thumbnails need Pillow to be installed")
+
+    tmp_dir = os.path.join(_root(), "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir, suffix=".jpg")
+    try:
+        with Image.open(blob_path(sha256)) as image, os.fdopen(fd, "wb") as tmp:
+            image.thumbnail(THUMBNAIL_SIZE)
+            image.convert("RGB").save(tmp, "JPEG", quality=80)
+        _replace_into(tmp_path, path)
+        tmp_path = None
+        return path
+    finally:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+@job_handler("attachment_thumbnail")
+def _thumbnail_job(context, sha256):
+    make_thumbnail(sha256)
+    return {"sha256": sha256}
+
+def sweep_unreferenced_blobs(min_age=SWEEP_MIN_AGE, batch_size=500):
+    """Delete stored files no attachment row points at anymore; returns how many were removed."""
+    blobs_dir = os.path.join(_root(), "blobs")
+    cutoff = (datetime.datetime.now() - min_age).timestamp()
+    candidates = []
+    for directory, _, files in os.walk(blobs_dir):
+        for name in files:
+            if SHA256_PATTERN.fullmatch(name) and os.path.getmtime(os.path.join(directory, name)) < cutoff:
+                candidates.append(name)
+
+    removed = 0
+    for start in range(0, len(candidates), batch_size):
+        batch = candidates[start:start + batch_size]
+        referenced = set(db.session.scalars(select(ExpenseAttachment.sha256.distinct())
+                                            .where(ExpenseAttachment.sha256.in_(batch))))
+        for sha256 in set(batch) - referenced:
+            if _remove_if_stale(blob_path(sha256), cutoff):
+                if os.path.exists(thumbnail_path(sha256)):
+                    os.remove(thumbnail_path(sha256))
+                removed += 1
+    return removed
+
+def _remove_if_stale(path, cutoff):
+    """Remove a blob unless an upload refreshed its mtime since it was listed.
+
+    The blob is first moved aside, so an upload either refreshed it before the move (we
+    see the new mtime and put it back) or finds it missing and stores its own copy.
+    """
+    tmp_dir = os.path.join(_root(), "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    aside = os.path.join(tmp_dir, os.path.basename(path) + ".sweep")
+    try:
+        os.replace(path, aside)
+    except FileNotFoundError:
+        return False
+    if os.path.getmtime(aside) >= cutoff:
+        os.replace(aside, path) # Same content as any copy an upload stored meanwhile
+        return False
+    os.remove(aside)
+    return True
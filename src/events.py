@@ -0,0 +1,91 @@
+import queue
+import threading
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from src.models.user import db
+
+# Key in Session.info holding events that wait for the transaction to commit
+PENDING_EVENTS_KEY = "pending_family_events"
+
+class LocalFanout:
+    """Fan-out for a single worker process: hands events straight back to the broadcaster.
+
+    A cross-worker implementation (Redis pub/sub, Postgres LISTEN/NOTIFY, ...) needs the
+    same two methods: start(deliver) is called once with the local delivery callback, and
+    publish(family_id, event) must end up calling deliver(family_id, event) in every worker.
+    """
+
+    def start(self, deliver):
+        self._deliver = deliver
+
+    def publish(self, family_id, event):
+        self._deliver(family_id, event)
+
+class FamilyBroadcaster:
+    """Keeps the open event streams of this process, grouped by family.
+
+    Every open stream holds one server thread for as long as the client stays connected,
+    so max_subscribers caps them per process; keep it below the worker's thread count
+    (gunicorn --threads) so ordinary requests always find a free thread. None means no cap,
+    which is only safe under gevent/eventlet workers where a stream costs a greenlet.
+    """
+
+    # Events buffered per subscriber; a client further behind should resync through /api/changes
+    QUEUE_SIZE = 100
+
+    def __init__(self, fanout=None, max_subscribers=None):
+        self._subscribers = {}
+        self._count = 0
+        self._lock = threading.Lock()
+        self.max_subscribers = max_subscribers
+        self.set_fanout(fanout or LocalFanout())
+
+    def set_fanout(self, fanout):
+        fanout.start(self._deliver)
+        self.fanout = fanout
+
+    def subscribe(self, family_id):
+        """Return a new subscriber queue, or None when this process already serves max_subscribers streams."""
+        subscriber = queue.Queue(maxsize=self.QUEUE_SIZE)
+        with self._lock:
+            if self.max_subscribers is not None and self._count >= self.max_subscribers:
+                return None
+            self._subscribers.setdefault(family_id, set()).add(subscriber)
+            self._count += 1
+        return subscriber
+
+    def unsubscribe(self, family_id, subscriber):
+        with self._lock:
+            family_subscribers = self._subscribers.get(family_id)
+            if family_subscribers and subscriber in family_subscribers:
+                family_subscribers.discard(subscriber)
+                self._count -= 1
+                if not family_subscribers:
+                    del self._subscribers[family_id]
+
+    def publish(self, family_id, event):
+        self.fanout.publish(family_id, event)
+
+    def publish_after_commit(self, family_id, event):
+        """Queue an event on the current DB session; it is published only if the session commits."""
+        db.session.info.setdefault(PENDING_EVENTS_KEY, []).append((family_id, event))
+
+    def _deliver(self, family_id, event):
+        with self._lock:
+            family_subscribers = list(self._subscribers.get(family_id, ()))
+        for subscriber in family_subscribers:
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                pass # Slow client, it catches up through /api/changes
+
+broadcaster = FamilyBroadcaster()
+
+@event.listens_for(Session, "after_commit")
+def _publish_pending_events(session):
+    for family_id, pending_event in session.info.pop(PENDING_EVENTS_KEY, None) or ():
+        broadcaster.publish(family_id, pending_event)
+
+@event.listens_for(Session, "after_rollback")
+def _discard_pending_events(session):
+    session.info.pop(PENDING_EVENTS_KEY, None)
@@ -0,0 +1,95 @@
+import datetime
+import hashlib
+from functools import wraps
+from flask import request, jsonify, make_response
+from flask_login import current_user
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from src.models.user import db, IdempotencyKey
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+# How long a stored response can be replayed
+IDEMPOTENCY_TTL = datetime.timedelta(hours=24)
+# A key still without a response after this long was left by a process that died after the
+# view committed; keep it above the slowest request
+IDEMPOTENCY_PENDING_TIMEOUT = datetime.timedelta(minutes=2)
+
+def _replay(entry):
+    response = make_response(entry.response_body, entry.status_code)
+    response.mimetype = "application/json"
+    response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+def _conflict_or_replay(entry, request_hash):
+    if entry is None:
+        return jsonify({"error": "A request with this Idempotency-Key is still being processed"}), 409
+    if entry.request_hash != request_hash:
+        return jsonify({"error": f"{IDEMPOTENCY_HEADER} was already used for a different request"}), 422
+    if entry.status_code is None:
+        return jsonify({"error": "A request with this Idempotency-Key is still being processed"}), 409
+    return _replay(entry)
+
+def idempotent(view):
+    """Replay the stored response when a create request is retried with the same Idempotency-Key.
+
+    The key row is flushed inside the view's transaction, so it only survives if the
+    view commits; failed requests leave nothing behind and can be retried. A retry
+    costs a single primary-key lookup on (user_id, key). The response is stored by a
+    second commit; a key that never got it within IDEMPOTENCY_PENDING_TIMEOUT is taken
+    over by the next retry, which runs the request again.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not key:
+            return view(*args, **kwargs)
+        if len(key) > 255:
+            return jsonify({"error": f"{IDEMPOTENCY_HEADER} must be at most 255 characters"}), 400
+
+        request_hash = hashlib.sha256(b"\n".join([
+            request.method.encode(), request.path.encode(), request.get_data()
+        ])).hexdigest()
+        now = datetime.datetime.utcnow()
+
+        entry = db.session.get(IdempotencyKey, (current_user.id, key))
+        if (entry and entry.expires_at > now and entry.status_code is None and entry.request_hash == request_hash
+                and entry.created_at < now - IDEMPOTENCY_PENDING_TIMEOUT):
+            # Abandoned: only one retry wins the conditional UPDATE, which holds the row until the view commits
+            taken = db.session.execute(
+                update(IdempotencyKey)
+                .where(IdempotencyKey.user_id == entry.user_id, IdempotencyKey.key == entry.key,
+                       IdempotencyKey.status_code.is_(None), IdempotencyKey.created_at == entry.created_at)
+                .values(created_at=now, expires_at=now + IDEMPOTENCY_TTL)
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            if not taken:
+                db.session.rollback()
+                return _conflict_or_replay(None, request_hash)
+        elif entry and entry.expires_at > now:
+            return _conflict_or_replay(entry, request_hash)
+        else:
+            if entry:
+                db.session.delete(entry)
+
+            entry = IdempotencyKey(user_id=current_user.id, key=key, request_hash=request_hash,
+                                   created_at=now, expires_at=now + IDEMPOTENCY_TTL)
+            db.session.add(entry)
+            try:
+                db.session.flush()
+            except IntegrityError:
+                # A concurrent request with the same key got there first
+                db.session.rollback()
+                entry = db.session.get(IdempotencyKey, (current_user.id, key))
+                return _conflict_or_replay(entry, request_hash)
+
+        response = make_response(view(*args, **kwargs))
+        if response.status_code >= 400:
+            db.session.rollback() # Drop the key with whatever the view left uncommitted
+            return response
+
+        entry.status_code = response.status_code
+        entry.response_body = response.get_data(as_text=True)
+        db.session.commit()
+        return response
+
+    return wrapper
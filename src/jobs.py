@@ -0,0 +1,244 @@
+import datetime
+import os
+import socket
+import threading
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import event, select, update
+from sqlalchemy.orm import Session
+from src.models.user import db, Job
+
+# Key in Session.info set when the transaction enqueued jobs, so idle workers wake up on commit
+JOBS_ENQUEUED_KEY = "jobs_enqueued"
+
+FINISHED_STATUSES = ("succeeded", "failed", "cancelled")
+
+# Handlers by job kind, filled by @job_handler in the modules that own the work
+JOB_HANDLERS = {}
+# Params checks of the kinds clients may queue through POST /api/jobs; every other kind is internal
+PUBLIC_JOB_PARAMS = {}
+
+_wakeup = threading.Event()
+
+class JobCancelled(Exception):
+    """Raised from JobContext.progress once cancellation of the job was requested."""
+
+def job_handler(kind, public_params=None):
+    """Register fn(context, **params) as the handler of a job kind.
+
+    The handler runs inside an app context with its own db.session. Work committed before a
+    crash is not rolled back, so a handler must be safe to run again on the same params:
+    jobs whose worker died are picked up again.
+
+    Only kinds given public_params can be queued by clients. It is called with the client's
+    params and returns the params to queue, raising ValueError for anything it does not accept.
+    """
+    def decorator(fn):
+        JOB_HANDLERS[kind] = fn
+        if public_params:
+            PUBLIC_JOB_PARAMS[kind] = public_params
+        return fn
+    return decorator
+
+def public_job_params(kind, params):
+    """Checked params of a job a client asked for; raises ValueError for internal or unknown kinds."""
+    if kind not in PUBLIC_JOB_PARAMS:
+        raise ValueError(f"Unknown job kind: {kind}")
+    return PUBLIC_JOB_PARAMS[kind](params)
+
+def enqueue(kind, family_id, user_id, params=None):
+    """Add a job to the current session; it becomes visible to the workers once the caller commits."""
+    if kind not in JOB_HANDLERS:
+        raise ValueError(f"Unknown job kind: {kind}")
+    job = Job(family_id=family_id, user_id=user_id, kind=kind, params=params or {})
+    db.session.add(job)
+    db.session.info[JOBS_ENQUEUED_KEY] = True
+    return job
+
+def request_cancel(job):
+    """Cancel a queued job right away, or ask a running one to stop at its next progress report."""
+    if job.status == "queued":
+        job.status = "cancelled"
+        job.finished_at = datetime.datetime.utcnow()
+    elif job.status == "running":
+        job.cancel_requested = True
+
+@event.listens_for(Session, "after_commit")
+def _wake_workers(session):
+    if session.info.pop(JOBS_ENQUEUED_KEY, None):
+        _wakeup.set()
+
+@event.listens_for(Session, "after_rollback")
+def _forget_enqueued(session):
+    session.info.pop(JOBS_ENQUEUED_KEY, None)
+
+class JobContext:
+    """Handed to a running handler to report progress and notice cancellation."""
+
+    def __init__(self, job, worker_id):
+        self.job_id = job.id
+        self.family_id = job.family_id
+        self.user_id = job.user_id
+        self._worker_id = worker_id
+
+    def progress(self, percent):
+        """Store progress on a separate connection, so it is visible before the handler commits.
+
+        Raises JobCancelled if cancellation was requested in the meantime.
+        """
+        with db.engine.begin() as connection:
+            connection.execute(update(Job).where(Job.id == self.job_id, Job.worker_id == self._worker_id)
+                               .values(progress=max(0, min(100, int(percent))),
+                                       heartbeat_at=datetime.datetime.utcnow()))
+            cancel_requested = connection.scalar(select(Job.cancel_requested).where(Job.id == self.job_id))
+        if cancel_requested:
+            raise JobCancelled()
+
+class JobWorker:
+    """Threads of one process that claim queued jobs from the job table and run them.
+
+    Any number of processes can run workers against the same database: a job is claimed
+    with a conditional UPDATE, so only one of them gets it. A running job's heartbeat is
+    refreshed while its worker lives; once it goes stale the job is queued again, which is
+    how jobs survive a worker being killed or restarted.
+    """
+
+    POLL_INTERVAL = 5 # Seconds between looks at the queue when no commit woke the worker
+    HEARTBEAT_INTERVAL = 30
+    HEARTBEAT_TIMEOUT = 120 # A running job without heartbeat for this long is taken over
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, app, threads=2):
+        self.app = app
+        self.threads = threads
+        self.worker_id = None
+        self._running_jobs = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        """Start the threads once per process; cheap to call again, e.g. before every request."""
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            # Taken at start, not in __init__, so forked server workers get their own id
+            self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+            threads = [threading.Thread(target=self._run_loop, name=f"job-worker-{index}", daemon=True)
+                       for index in range(self.threads)]
+            threads.append(threading.Thread(target=self._heartbeat_loop, name="job-heartbeat", daemon=True))
+            for thread in threads:
+                thread.start()
+            self._threads = threads
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        _wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _run_loop(self):
+        while not self._stop.is_set():
+            try:
+                with self.app.app_context():
+                    self.requeue_stale()
+                    ran = self.run_next()
+            except Exception as e:
+                self.app.logger.exception("Job worker error: %s", e)
+                ran = False
+            if not ran:
+                _wakeup.wait(self.POLL_INTERVAL)
+                _wakeup.clear()
+
+    def _heartbeat_loop(self):
+        while not self._stop.wait(self.HEARTBEAT_INTERVAL):
+            with self._lock:
+                job_ids = list(self._running_jobs)
+            if not job_ids:
+                continue
+            try:
+                with self.app.app_context(), db.engine.begin() as connection:
+                    connection.execute(update(Job).where(Job.id.in_(job_ids), Job.worker_id == self.worker_id)
+                                       .values(heartbeat_at=datetime.datetime.utcnow()))
+            except Exception as e:
+                self.app.logger.exception("Job heartbeat error: %s", e)
+
+    def requeue_stale(self):
+        """Give jobs of dead workers back to the queue, or fail them after MAX_ATTEMPTS."""
+        now = datetime.datetime.utcnow()
+        stale = (Job.status == "running") & (Job.heartbeat_at < now - datetime.timedelta(seconds=self.HEARTBEAT_TIMEOUT))
+        db.session.execute(update(Job).where(stale, Job.cancel_requested)
+                           .values(status="cancelled", worker_id=None, finished_at=now))
+        db.session.execute(update(Job).where(stale, Job.attempts >= self.MAX_ATTEMPTS)
+                           .values(status="failed", worker_id=None, finished_at=now,
+                                   error="Worker stopped responding too many times"))
+        db.session.execute(update(Job).where(stale).values(status="queued", worker_id=None))
+        db.session.commit()
+
+    def claim(self):
+        """Take the oldest queued job, or return None when the queue is empty."""
+        candidates = db.session.scalars(select(Job.id).where(Job.status == "queued").order_by(Job.id).limit(10)).all()
+        for job_id in candidates:
+            now = datetime.datetime.utcnow()
+            claimed = db.session.execute(
+                update(Job).where(Job.id == job_id, Job.status == "queued")
+                .values(status="running", worker_id=self.worker_id, attempts=Job.attempts + 1,
+                        started_at=now, heartbeat_at=now)
+            ).rowcount
+            db.session.commit()
+            if claimed:
+                return db.session.get(Job, job_id)
+        return None
+
+    def run_next(self):
+        """Claim and run one job; returns False when there was nothing to do."""
+        job = self.claim()
+        if not job:
+            return False
+
+        with self._lock:
+            self._running_jobs.add(job.id)
+        job_id = job.id
+        handler = JOB_HANDLERS.get(job.kind)
+        context = JobContext(job, self.worker_id)
+        try:
+            if not handler:
+                raise ValueError(f"Unknown job kind: {job.kind}")
+            result = handler(context, **(job.params or {}))
+            db.session.commit()
+            self._finish(job_id, status="succeeded", progress=100, result=result)
+        except JobCancelled:
+            db.session.rollback()
+            self._finish(job_id, status="cancelled")
+        except Exception as e:
+            db.session.rollback()
+            self.app.logger.exception("Job %s failed", job_id)
+            self._finish(job_id, status="failed", error=str(e))
+        finally:
+            with self._lock:
+                self._running_jobs.discard(job_id)
+            db.session.remove()
+        return True
+
+    def _finish(self, job_id, **values):
+        # Only if still ours: a job taken over after a stale heartbeat belongs to another worker now
+        db.session.execute(update(Job).where(Job.id == job_id, Job.worker_id == self.worker_id)
+                           .values(finished_at=datetime.datetime.utcnow(), **values))
+        db.session.commit()
+
+@click.command("run-jobs")
+@click.option("--threads", type=int, default=2, show_default=True, help="Jobs run at the same time.")
+@with_appcontext
+def run_jobs_command(threads):
+    """Run background job workers in the foreground until interrupted."""
+    worker = JobWorker(current_app._get_current_object(), threads=threads)
+    worker.start()
+    click.echo(f"Job worker {worker.worker_id} running {threads} threads")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        worker.stop()
@@ -1,28 +1,93 @@
 import os
+import secrets
 import sys
 # DON'T CHANGE THIS !!!
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
 from flask import Flask, send_from_directory
-from src.models.user import db
-from src.routes.user import user_bp
+from flask_login import LoginManager
+from src.models.user import db, User, Category, CategoryClosure
+from src.routes.user import user_bp, load_user_from_token
 from src.routes.transactions import expense_bp, credit_bp
 from src.routes.recurring_transactions import recurring_expense_bp
 from src.routes.reports import reports_bp
+from src.routes.changes import changes_bp
+from src.routes.events import events_bp
+from src.routes.archive import archive_bp
+from src.routes.budgets import budget_bp
+from src.routes.jobs import jobs_bp
+from src.routes.attachments import attachments_bp
+from src.rollup import rollup_trends_command
+from src.jobs import JobWorker, run_jobs_command
+from src.events import broadcaster
 
 app = Flask(__name__, static_folder=os.path.join(os.path.dirname(__file__), 'static'))
-app.config['SECRET_KEY'] = 'asdf#FGSgvasgf$5$WGT'
+# Signs session cookies and Bearer tokens; anyone who knows it can log in as any user
+app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
+if not app.config['SECRET_KEY']:
+    if __name__ != '__main__' and os.getenv('FLASK_DEBUG') not in ('1', 'true'):
+        raise RuntimeError("SECRET_KEY environment variable is required")
+    # Development server only: a throwaway key, so logins do not survive a restart
+    app.config['SECRET_KEY'] = secrets.token_hex(32)
 
 app.register_blueprint(user_bp, url_prefix="/api")
 app.register_blueprint(expense_bp, url_prefix="/api")
 app.register_blueprint(credit_bp, url_prefix="/api")
 app.register_blueprint(recurring_expense_bp, url_prefix="/api")
-app.register_blueprint(reports_bp, url_prefix="/api")# uncomment if you need to use database
-app.config['SQLALCHEMY_DATABASE_URI'] = f"mysql+pymysql://{os.getenv('DB_USERNAME', 'root')}:{os.getenv('DB_PASSWORD', 'password')}@{os.getenv('DB_HOST', 'localhost')}:{os.getenv('DB_PORT', '3306')}/{os.getenv('DB_NAME', 'family_expense_manager_db')}"
+app.register_blueprint(reports_bp, url_prefix="/api")
+app.register_blueprint(changes_bp, url_prefix="/api")
+app.register_blueprint(events_bp, url_prefix="/api")
+app.register_blueprint(archive_bp, url_prefix="/api")
+app.register_blueprint(budget_bp, url_prefix="/api")
+app.register_blueprint(jobs_bp, url_prefix="/api")
+app.register_blueprint(attachments_bp, url_prefix="/api")# uncomment if you need to use database
+app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL') or f"mysql+pymysql://{os.getenv('DB_USERNAME', 'root')}:{os.getenv('DB_PASSWORD', 'password')}@{os.getenv('DB_HOST', 'localhost')}:{os.getenv('DB_PORT', '3306')}/{os.getenv('DB_NAME', 'family_expense_manager_db')}"
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Receipt files, content-addressed; keep on a persistent volume shared by all app servers
+app.config['ATTACHMENT_DIR'] = os.getenv('ATTACHMENT_DIR') or os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'instance', 'attachments')
+if os.getenv('DB_POOL_SIZE'):
+    # Connections per worker process; size together with the WSGI worker count
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': int(os.getenv('DB_POOL_SIZE')),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', '10'))
+    }
 db.init_app(app)
+app.cli.add_command(rollup_trends_command)
+app.cli.add_command(run_jobs_command)
+
+login_manager = LoginManager(app)
+
+@login_manager.user_loader
+def load_user(user_id):
+    return db.session.get(User, int(user_id))
+
+@login_manager.request_loader
+def load_user_from_request(request):
+    auth_header = request.headers.get('Authorization', '')
+    if auth_header.startswith('Bearer '):
+        return load_user_from_token(auth_header[len('Bearer '):])
+    return None
+
+@login_manager.unauthorized_handler
+def unauthorized():
+    return {"error": "Authentication required"}, 401
+
 with app.app_context():
     db.create_all()
+    # Backfill the category tree for databases created before the closure table existed
+    if Category.query.first() and not CategoryClosure.query.first():
+        CategoryClosure.rebuild()
+
+# Background jobs run in the serving process unless JOB_WORKER_THREADS=0, e.g. when a separate
+# `flask run-jobs` process is deployed. They start with the first request a process serves, so
+# merely importing the app (CLI commands, the reloader's parent, a gunicorn master) never runs jobs.
+job_worker = JobWorker(app, threads=int(os.getenv('JOB_WORKER_THREADS', '2')))
+if job_worker.threads:
+    app.before_request(job_worker.start)
+
+# Open /api/events streams per process. Each one holds a server thread, so with gunicorn gthread
+# workers keep this below --threads; set it to 0 for no cap only under gevent/eventlet workers.
+broadcaster.max_subscribers = int(os.getenv('SSE_MAX_SUBSCRIBERS', '4')) or None
 
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
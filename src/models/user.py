@@ -1,10 +1,45 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import event, select, literal, inspect, true, func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from sqlalchemy.dialects import mysql, postgresql, sqlite
 import datetime
 
 db = SQLAlchemy()
 
+def upsert(table, conflict_columns, update_columns=(), values=None, from_select=None, returning=None):
+    """Run a dialect-native upsert into table and return the result.
+
+    Pass either values (a dict or a list of dicts) or from_select (a (columns, select) pair).
+    Rows that clash on conflict_columns get update_columns overwritten with the incoming
+    values; with no update_columns they are left untouched. Other dialects get a plain
+    INSERT, which raises IntegrityError on a clash.
+    """
+    dialect = db.session.get_bind().dialect.name
+    dialect_insert = {'mysql': mysql.insert, 'postgresql': postgresql.insert, 'sqlite': sqlite.insert}.get(dialect)
+    stmt = dialect_insert(table) if dialect_insert else table.insert()
+    stmt = stmt.values(values) if values is not None else stmt.from_select(*from_select)
+
+    if dialect == 'mysql':
+        # id = id is a no-op, so a clash neither changes the row nor sets lastrowid
+        assignments = {column: stmt.inserted[column] for column in update_columns}
+        stmt = stmt.on_duplicate_key_update(assignments or {pk.name: pk for pk in table.primary_key.columns})
+    elif dialect_insert and update_columns:
+        stmt = stmt.on_conflict_do_update(index_elements=conflict_columns,
+                                          set_={column: stmt.excluded[column] for column in update_columns})
+    elif dialect_insert:
+        stmt = stmt.on_conflict_do_nothing(index_elements=conflict_columns)
+    if returning is not None:
+        stmt = stmt.returning(*returning)
+    return db.session.execute(stmt)
+
+def json_object(fields):
+    """SQL expression building a JSON object from a {key: column or expression} dict."""
+    build = func.json_build_object if db.session.get_bind().dialect.name == 'postgresql' else func.json_object
+    return build(*[part for key, value in fields.items() for part in (literal(key), value)])
+
 # Association table for User and Family (many-to-many)
 family_members = db.Table('family_members',
     db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
@@ -20,7 +55,7 @@ class User(UserMixin, db.Model):
     created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     # Relationship to families they are part of
     families = db.relationship('Family', secondary=family_members,
-                               lazy='subquery', backref=db.backref('members', lazy=True))
+                               lazy='select', backref=db.backref('members', lazy=True))
 
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
@@ -40,6 +75,14 @@ class Family(db.Model):
     categories = db.relationship('Category', backref='family', lazy=True, cascade="all, delete-orphan")
     payment_types = db.relationship('PaymentType', backref='family', lazy=True, cascade="all, delete-orphan")
 
+    @classmethod
+    def for_member(cls, family_id, user):
+        """Return the family if user belongs to it, else None (also when it does not exist)."""
+        family = cls.query.get(family_id)
+        if not family or user not in family.members:
+            return None
+        return family
+
     def __repr__(self):
         return f'<Family {self.name}>'
 
@@ -54,9 +97,80 @@ class Budget(db.Model):
     # Relationships
     expenses = db.relationship('Expense', backref='budget', lazy=True)
     credits = db.relationship('Credit', backref='budget', lazy=True)
+    category_plans = db.relationship('CategoryPlan', backref='budget', lazy=True, cascade="all, delete-orphan")
 
     __table_args__ = (db.UniqueConstraint('family_id', 'month', 'year', name='uq_family_month_year'),)
 
+    # How many times find_or_create retries after losing a race on uq_family_month_year
+    FIND_OR_CREATE_RETRIES = 3
+
+    @classmethod
+    def find_or_create(cls, family_id, year, month, planned_amount=0):
+        """Return the budget for family/month/year, creating it atomically if missing.
+
+        Concurrent requests for a new month all end up with the same row instead of
+        one of them failing on uq_family_month_year. The insert runs inside a
+        SAVEPOINT so the caller's transaction survives a unique violation.
+        """
+        budget = cls.query.filter_by(family_id=family_id, year=year, month=month).first()
+        if budget:
+            return budget
+
+        for _ in range(cls.FIND_OR_CREATE_RETRIES):
+            budget_id, created = None, False
+            try:
+                with db.session.begin_nested():
+                    budget_id, created = cls._upsert(family_id, year, month, planned_amount)
+            except IntegrityError:
+                pass # Lost the race on a dialect without native upsert, read the winner's row
+
+            if budget_id:
+                budget = db.session.get(cls, budget_id)
+            else:
+                # Locking read so MySQL/Postgres see the row committed by the concurrent writer
+                budget = (cls.query.filter_by(family_id=family_id, year=year, month=month)
+                          .with_for_update().populate_existing().first())
+            if budget:
+                if created:
+                    ChangeLog.record(family_id, 'budget', budget.id, 'create', budget.to_dict())
+                return budget
+
+        raise RuntimeError(f"Could not find or create budget {family_id} - {month}/{year}")
+
+    @classmethod
+    def _upsert(cls, family_id, year, month, planned_amount):
+        """Insert the budget row unless it exists.
+
+        Returns (budget_id, created); budget_id is None when the row already existed.
+        """
+        values = dict(family_id=family_id, year=year, month=month, planned_amount=planned_amount,
+                      created_at=datetime.datetime.utcnow(), updated_at=datetime.datetime.utcnow())
+        dialect = db.session.get_bind().dialect.name
+        result = upsert(cls.__table__, ['family_id', 'month', 'year'], values=values,
+                        returning=[cls.__table__.c.id] if dialect == 'postgresql' else None)
+
+        if dialect == 'postgresql':
+            budget_id = result.scalar()
+            return budget_id, budget_id is not None
+        if dialect == 'mysql':
+            # Only a real insert sets lastrowid. rowcount cannot tell: the driver sets
+            # CLIENT.FOUND_ROWS, so a matched duplicate also reports one row.
+            return result.lastrowid or None, bool(result.lastrowid)
+        if dialect == 'sqlite':
+            created = result.rowcount == 1
+            return (result.lastrowid if created else None), created
+        return result.inserted_primary_key[0], True
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "family_id": self.family_id,
+            "year": self.year,
+            "month": self.month,
+            "planned_amount": float(self.planned_amount),
+            "updated_at": self.updated_at.isoformat() if self.updated_at else None
+        }
+
     def __repr__(self):
         return f'<Budget {self.family_id} - {self.month}/{self.year}>'
 
@@ -66,13 +180,109 @@ class Category(db.Model):
     family_id = db.Column(db.Integer, db.ForeignKey('family.id'), nullable=False)
     parent_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=True) # For subcategories
     subcategories = db.relationship('Category', backref=db.backref('parent', remote_side=[id]), lazy='dynamic')
-    expenses = db.relationship('Expense', backref='category', lazy=True)
+    expenses = db.relationship('Expense', backref='category', lazy=True, foreign_keys='Expense.category_id')
 
     __table_args__ = (db.UniqueConstraint('family_id', 'name', 'parent_id', name='uq_family_category_name'),)
 
+    @classmethod
+    def find_descendant(cls, family_id, ancestor_id, category_id):
+        """Return category_id if it belongs to the family and sits anywhere below ancestor_id."""
+        return (cls.query.join(CategoryClosure, CategoryClosure.descendant_id == cls.id)
+                .filter(cls.id == category_id, cls.family_id == family_id,
+                        CategoryClosure.ancestor_id == ancestor_id, CategoryClosure.depth > 0)
+                .first())
+
     def __repr__(self):
         return f'<Category {self.name}>'
 
+class CategoryClosure(db.Model):
+    """Every ancestor/descendant pair of the category tree, each node paired with itself at depth 0.
+
+    Kept in sync by the Category mapper events below, so subtree totals are a single
+    join on descendant_id instead of walking parent_id level by level.
+    """
+    ancestor_id = db.Column(db.Integer, db.ForeignKey('category.id', ondelete='CASCADE'), primary_key=True)
+    descendant_id = db.Column(db.Integer, db.ForeignKey('category.id', ondelete='CASCADE'), primary_key=True)
+    depth = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (db.Index('ix_category_closure_descendant_ancestor', 'descendant_id', 'ancestor_id', 'depth'),)
+
+    @classmethod
+    def rebuild(cls):
+        """Recompute the whole table from Category.parent_id, one INSERT ... SELECT per tree level."""
+        closure = cls.__table__
+        category = Category.__table__
+        db.session.execute(closure.delete())
+        db.session.execute(closure.insert().from_select(
+            ['ancestor_id', 'descendant_id', 'depth'],
+            select(category.c.id, category.c.id, literal(0))
+        ))
+        depth = 0
+        while True:
+            result = db.session.execute(closure.insert().from_select(
+                ['ancestor_id', 'descendant_id', 'depth'],
+                select(closure.c.ancestor_id, category.c.id, literal(depth + 1))
+                .select_from(closure.join(category, category.c.parent_id == closure.c.descendant_id))
+                .where(closure.c.depth == depth)
+            ))
+            if not result.rowcount:
+                break
+            depth += 1
+        db.session.commit()
+
+@event.listens_for(Category, 'after_insert')
+def _category_closure_insert(mapper, connection, target):
+    closure = CategoryClosure.__table__
+    connection.execute(closure.insert().values(ancestor_id=target.id, descendant_id=target.id, depth=0))
+    if target.parent_id is not None:
+        connection.execute(closure.insert().from_select(
+            ['ancestor_id', 'descendant_id', 'depth'],
+            select(closure.c.ancestor_id, literal(target.id), closure.c.depth + 1)
+            .where(closure.c.descendant_id == target.parent_id)
+        ))
+
+@event.listens_for(Category, 'after_update')
+def _category_closure_move(mapper, connection, target):
+    if not inspect(target).attrs.parent_id.history.has_changes():
+        return
+    closure = CategoryClosure.__table__
+    subtree_ids = list(connection.execute(
+        select(closure.c.descendant_id).where(closure.c.ancestor_id == target.id)).scalars())
+    if target.parent_id in subtree_ids:
+        raise ValueError("A category cannot be moved below one of its own subcategories")
+
+    # Detach the subtree from its old ancestors, then hang it under the new parent's ancestors
+    connection.execute(closure.delete().where(
+        closure.c.descendant_id.in_(subtree_ids), closure.c.ancestor_id.notin_(subtree_ids)))
+    if target.parent_id is not None:
+        parent_path = closure.alias('parent_path')
+        subtree = closure.alias('subtree')
+        connection.execute(closure.insert().from_select(
+            ['ancestor_id', 'descendant_id', 'depth'],
+            select(parent_path.c.ancestor_id, subtree.c.descendant_id, parent_path.c.depth + subtree.c.depth + 1)
+            .select_from(parent_path.join(subtree, true())) # Every new ancestor times every subtree node
+            .where(parent_path.c.descendant_id == target.parent_id, subtree.c.ancestor_id == target.id)
+        ))
+
+@event.listens_for(Category, 'before_delete')
+def _category_closure_delete(mapper, connection, target):
+    closure = CategoryClosure.__table__
+    connection.execute(closure.delete().where(
+        (closure.c.ancestor_id == target.id) | (closure.c.descendant_id == target.id)))
+
+class CategoryPlan(db.Model):
+    """Planned amount for one category within a month's budget."""
+    id = db.Column(db.Integer, primary_key=True)
+    budget_id = db.Column(db.Integer, db.ForeignKey('budget.id'), nullable=False)
+    category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=False)
+    planned_amount = db.Column(db.Numeric(10, 2), nullable=False, default=0.00)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+    __table_args__ = (db.UniqueConstraint('budget_id', 'category_id', name='uq_budget_category_plan'),)
+
+    def __repr__(self):
+        return f'<CategoryPlan {self.budget_id} - {self.category_id}: {self.planned_amount}>'
+
 class PaymentType(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
@@ -98,9 +308,29 @@ class Expense(db.Model):
     created_by_user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     updated_by_user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
 
+    subcategory = db.relationship('Category', foreign_keys=[subcategory_id])
     created_by = db.relationship('User', foreign_keys=[created_by_user_id])
     updated_by = db.relationship('User', foreign_keys=[updated_by_user_id])
 
+    # Ids are never handed out twice, not even after the newest rows were archived, so a restored
+    # year gets its ids back and attachments keep pointing at the right expense
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "budget_id": self.budget_id,
+            "category_id": self.category_id,
+            "subcategory_id": self.subcategory_id,
+            "payment_type_id": self.payment_type_id,
+            "description": self.description,
+            "amount": float(self.amount),
+            "expense_date": self.expense_date.isoformat(),
+            "created_by_user_id": self.created_by_user_id,
+            "updated_by_user_id": self.updated_by_user_id,
+            "updated_at": self.updated_at.isoformat() if self.updated_at else None
+        }
+
     def __repr__(self):
         return f'<Expense {self.description} - {self.amount}>'
 
@@ -118,6 +348,20 @@ class Credit(db.Model):
     created_by = db.relationship('User', foreign_keys=[created_by_user_id])
     updated_by = db.relationship('User', foreign_keys=[updated_by_user_id])
 
+    __table_args__ = {'sqlite_autoincrement': True} # See Expense
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "budget_id": self.budget_id,
+            "description": self.description,
+            "amount": float(self.amount),
+            "credit_date": self.credit_date.isoformat(),
+            "created_by_user_id": self.created_by_user_id,
+            "updated_by_user_id": self.updated_by_user_id,
+            "updated_at": self.updated_at.isoformat() if self.updated_at else None
+        }
+
     def __repr__(self):
         return f'<Credit {self.description} - {self.amount}>'
 
@@ -146,6 +390,290 @@ class RecurringExpense(db.Model):
     created_by = db.relationship('User', foreign_keys=[created_by_user_id])
     updated_by = db.relationship('User', foreign_keys=[updated_by_user_id])
 
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "family_id": self.family_id,
+            "category_id": self.category_id,
+            "subcategory_id": self.subcategory_id,
+            "payment_type_id": self.payment_type_id,
+            "description": self.description,
+            "amount": float(self.amount),
+            "recurrence_type": self.recurrence_type,
+            "start_date": self.start_date.isoformat(),
+            "end_date": self.end_date.isoformat() if self.end_date else None,
+            "day_of_week": self.day_of_week,
+            "day_of_month": self.day_of_month,
+            "updated_at": self.updated_at.isoformat() if self.updated_at else None
+        }
+
     def __repr__(self):
         return f'<RecurringExpense {self.description} - {self.amount}>'
 
+class ExpenseAttachment(db.Model):
+    """Receipt attached to an expense; the file lives in the content-addressed store of src/attachments.py."""
+    id = db.Column(db.Integer, primary_key=True)
+    family_id = db.Column(db.Integer, db.ForeignKey('family.id'), nullable=False)
+    expense_id = db.Column(db.Integer, nullable=False, index=True) # No FK: attachments outlive expenses of archived years
+    sha256 = db.Column(db.String(64), nullable=False, index=True)
+    filename = db.Column(db.String(255), nullable=True)
+    content_type = db.Column(db.String(100), nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    created_by_user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    thumbnail_job_id = db.Column(db.Integer, db.ForeignKey('job.id'), nullable=True) # Last job asked to render the thumbnail
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "expense_id": self.expense_id,
+            "sha256": self.sha256,
+            "filename": self.filename,
+            "content_type": self.content_type,
+            "size": self.size,
+            "created_by_user_id": self.created_by_user_id,
+            "created_at": self.created_at.isoformat() if self.created_at else None
+        }
+
+    def __repr__(self):
+        return f'<ExpenseAttachment {self.expense_id}: {self.filename}>'
+
+class BudgetYearArchive(db.Model):
+    """Expenses and credits of a closed family-year, moved out of the hot tables.
+
+    data is one gzip-compressed JSON Lines blob; it is deferred so listing archives
+    never loads it.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    family_id = db.Column(db.Integer, db.ForeignKey('family.id'), nullable=False)
+    year = db.Column(db.Integer, nullable=False)
+    expense_count = db.Column(db.Integer, nullable=False, default=0)
+    credit_count = db.Column(db.Integer, nullable=False, default=0)
+    data = db.deferred(db.Column(db.LargeBinary(length=2**32 - 1), nullable=False))
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+    __table_args__ = (db.UniqueConstraint('family_id', 'year', name='uq_family_archive_year'),)
+
+    def to_dict(self):
+        return {
+            "family_id": self.family_id,
+            "year": self.year,
+            "expense_count": self.expense_count,
+            "credit_count": self.credit_count,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "updated_at": self.updated_at.isoformat() if self.updated_at else None
+        }
+
+    def __repr__(self):
+        return f'<BudgetYearArchive {self.family_id} - {self.year}>'
+
+class ArchivedBudgetTotal(db.Model):
+    """Pre-aggregated totals of archived rows, per budget month and category (credits have no category)."""
+    id = db.Column(db.Integer, primary_key=True)
+    budget_id = db.Column(db.Integer, db.ForeignKey('budget.id'), nullable=False, index=True)
+    entry_type = db.Column(db.String(10), nullable=False) # 'expense' or 'credit'
+    category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=True)
+    subcategory_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=True)
+    total_amount = db.Column(db.Numeric(12, 2), nullable=False, default=0.00)
+    entry_count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<ArchivedBudgetTotal {self.budget_id} {self.entry_type} - {self.total_amount}>'
+
+class IdempotencyKey(db.Model):
+    """Stored response of a create request, replayed when the client retries with the same Idempotency-Key."""
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    key = db.Column(db.String(255), primary_key=True)
+    request_hash = db.Column(db.String(64), nullable=False) # sha256 of method, path and body
+    status_code = db.Column(db.Integer, nullable=True) # None while the first request is still running
+    response_body = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    @classmethod
+    def purge_expired(cls):
+        """Delete expired keys through the expires_at index; the caller commits."""
+        return (db.session.query(cls).filter(cls.expires_at < datetime.datetime.utcnow())
+                .delete(synchronize_session=False))
+
+    def __repr__(self):
+        return f'<IdempotencyKey {self.user_id} - {self.key}>'
+
+class FamilyTrendStats(db.Model):
+    """Precomputed statistics cube of a family, written by the rollup-trends command."""
+    family_id = db.Column(db.Integer, db.ForeignKey('family.id'), primary_key=True)
+    data = db.Column(db.JSON, nullable=False)
+    duration_ms = db.Column(db.Integer, nullable=True) # Time the worker spent on this family
+    computed_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        return f'<FamilyTrendStats {self.family_id}>'
+
+class RollupRun(db.Model):
+    """One run of the rollup-trends command; an unfinished run is resumed by the next invocation."""
+    id = db.Column(db.Integer, primary_key=True)
+    started_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    family_count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<RollupRun {self.id}>'
+
+class Job(db.Model):
+    """Long-running operation queued for the background workers of src/jobs.py."""
+    id = db.Column(db.Integer, primary_key=True)
+    family_id = db.Column(db.Integer, db.ForeignKey('family.id'), nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    kind = db.Column(db.String(50), nullable=False)
+    params = db.Column(db.JSON, nullable=True)
+    status = db.Column(db.String(20), nullable=False, default='queued') # 'queued', 'running', 'succeeded', 'failed', 'cancelled'
+    progress = db.Column(db.Integer, nullable=False, default=0) # Percent
+    result = db.Column(db.JSON, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    worker_id = db.Column(db.String(100), nullable=True) # Worker holding the job while it runs
+    heartbeat_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (db.Index('ix_job_status_id', 'status', 'id'),)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "family_id": self.family_id,
+            "user_id": self.user_id,
+            "kind": self.kind,
+            "params": self.params,
+            "status": self.status,
+            "progress": self.progress,
+            "result": self.result,
+            "error": self.error,
+            "cancel_requested": self.cancel_requested,
+            "attempts": self.attempts,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None
+        }
+
+    def __repr__(self):
+        return f'<Job {self.id} {self.kind}: {self.status}>'
+
+class ChangeSequence(db.Model):
+    """Last ChangeLog.seq handed out per family.
+
+    Not a column of family on purpose: every insert of a row referencing the family takes
+    InnoDB's shared foreign-key lock on the family row, so two writers bumping a counter
+    there would each hold S and wait for X. Nothing references this table, so its row
+    lock is only taken by allocate().
+    """
+    family_id = db.Column(db.Integer, db.ForeignKey('family.id'), primary_key=True)
+    last_seq = db.Column(db.Integer, nullable=False, default=0)
+
+    @classmethod
+    def allocate(cls, family_id, count):
+        """Reserve count consecutive seqs of the family and return the first.
+
+        The row stays locked until the transaction ends, so allocations of one family
+        happen one transaction after the other.
+        """
+        table = cls.__table__
+        bump = table.update().where(table.c.family_id == family_id).values(last_seq=table.c.last_seq + count)
+        if not db.session.execute(bump).rowcount:
+            # First change of the family: start after anything already in the log
+            start = (select(literal(family_id), func.coalesce(func.max(ChangeLog.seq), 0))
+                     .where(ChangeLog.family_id == family_id))
+            upsert(table, ["family_id"], from_select=(["family_id", "last_seq"], start))
+            db.session.execute(bump)
+        return db.session.scalar(select(table.c.last_seq).where(table.c.family_id == family_id)) - count + 1
+
+class ConcurrentChange(Exception):
+    """Raised when rows matched by a set-based write changed while the write was being logged."""
+
+class ChangeLog(db.Model):
+    """Append-only feed of mutations per family, read by clients through /api/changes.
+
+    Rows are added in the same transaction as the change they describe, so the feed
+    never shows a change that was rolled back. The sync cursor is seq, a per-family
+    counter rather than the autoincrement id: ids are handed out at INSERT but become
+    visible at COMMIT, so a reader could pass id 11 while id 10 is still uncommitted
+    and never see it. seq comes from ChangeSequence under a row lock held until commit,
+    so a family's entries commit in seq order and a cursor never skips one.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    family_id = db.Column(db.Integer, db.ForeignKey('family.id'), nullable=False)
+    seq = db.Column(db.Integer, nullable=False)
+    entity_type = db.Column(db.String(30), nullable=False) # 'expense', 'credit', 'recurring_expense', 'budget', 'attachment'
+    entity_id = db.Column(db.Integer, nullable=False)
+    action = db.Column(db.String(10), nullable=False) # 'create', 'update', 'delete'
+    data = db.Column(db.JSON, nullable=True) # Snapshot after the change, None for deletes
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+    __table_args__ = (db.UniqueConstraint('family_id', 'seq', name='uq_change_log_family_seq'),)
+
+    @classmethod
+    def record(cls, family_id, entity_type, entity_id, action, data=None, user_id=None):
+        """Add a change entry to the current session; the caller's commit persists it.
+
+        seq is assigned when the session flushes, see _assign_change_seqs.
+        """
+        entry = cls(family_id=family_id, entity_type=entity_type, entity_id=entity_id,
+                    action=action, data=data, user_id=user_id)
+        db.session.add(entry)
+        db.session.info.setdefault(PENDING_CHANGES_KEY, []).append(entry)
+        return entry
+
+    @classmethod
+    def record_from_select(cls, family_id, entity_type, action, source, user_id=None):
+        """Log one entry per row of source, a select of entity_id and data columns, in one INSERT ... SELECT.
+
+        Returns how many entries were written. Their seqs are reserved from a count of source
+        first; ConcurrentChange is raised if the INSERT then sees a different number of rows.
+        """
+        count = db.session.scalar(select(func.count()).select_from(source.subquery()))
+        if not count:
+            return 0
+        first_seq = ChangeSequence.allocate(family_id, count)
+        rows = source.subquery()
+        entries = select(literal(family_id), literal(first_seq - 1) + func.row_number().over(order_by=rows.c.entity_id),
+                         literal(entity_type), rows.c.entity_id, literal(action), rows.c.data, literal(user_id),
+                         literal(datetime.datetime.utcnow()))
+        inserted = db.session.execute(cls.__table__.insert().from_select(
+            ["family_id", "seq", "entity_type", "entity_id", "action", "data", "user_id", "created_at"], entries)).rowcount
+        if inserted != count:
+            raise ConcurrentChange(f"{entity_type} rows changed while they were being logged")
+        return count
+
+    def to_dict(self):
+        return {
+            "cursor": self.seq,
+            "entity_type": self.entity_type,
+            "entity_id": self.entity_id,
+            "action": self.action,
+            "data": self.data,
+            "user_id": self.user_id,
+            "created_at": self.created_at.isoformat() if self.created_at else None
+        }
+
+# Key in Session.info listing ChangeLog entries that still need their seq, in record() order
+PENDING_CHANGES_KEY = "pending_change_log_entries"
+
+@event.listens_for(Session, "before_flush")
+def _assign_change_seqs(session, flush_context, instances):
+    entries = [entry for entry in session.info.pop(PENDING_CHANGES_KEY, None) or () if inspect(entry).pending]
+    by_family = {}
+    for entry in entries:
+        by_family.setdefault(entry.family_id, []).append(entry)
+
+    for family_id, family_entries in by_family.items():
+        first_seq = ChangeSequence.allocate(family_id, len(family_entries))
+        for offset, entry in enumerate(family_entries):
+            entry.seq = first_seq + offset
+
+@event.listens_for(Session, "after_rollback")
+def _discard_pending_changes(session):
+    session.info.pop(PENDING_CHANGES_KEY, None)
@@ -0,0 +1,188 @@
+import datetime
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import create_engine, select, func
+from src.models.user import (db, Budget, Category, Expense, Family, ArchivedBudgetTotal,
+                             FamilyTrendStats, RollupRun, IdempotencyKey)
+from src.jobs import job_handler
+from src.attachments import sweep_unreferenced_blobs
+
+PERCENTILES = (50, 90, 95)
+
+# Engine of the current worker process, created by _init_worker
+_worker_engine = None
+
+def _init_worker(database_uri):
+    global _worker_engine
+    # One connection per worker keeps the whole pool at --workers connections
+    _worker_engine = create_engine(database_uri, pool_size=1, max_overflow=0, pool_pre_ping=True)
+
+def _month_axis(first, last):
+    months = []
+    year, month = first
+    while (year, month) <= last:
+        months.append((year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+def _rolling_average(values, window):
+    averages = []
+    for index in range(len(values)):
+        chunk = values[max(0, index - window + 1):index + 1]
+        averages.append(round(sum(chunk) / len(chunk), 2))
+    return averages
+
+def _year_over_year(values):
+    return [round(values[index] - values[index - 12], 2) if index >= 12 else None for index in range(len(values))]
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return None
+    position = (len(sorted_values) - 1) * percent / 100
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return round(sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower), 2)
+
+def _series(values):
+    return {
+        "monthly": values,
+        "rolling_3": _rolling_average(values, 3),
+        "rolling_12": _rolling_average(values, 12),
+        "yoy": _year_over_year(values)
+    }
+
+def build_trend_cube(connection, family_id):
+    """Compute the statistics cube of one family from live expenses and archived totals."""
+    expense = Expense.__table__
+    budget = Budget.__table__
+    archived = ArchivedBudgetTotal.__table__
+    category = Category.__table__
+
+    monthly = {}
+    live = connection.execute(
+        select(budget.c.year, budget.c.month, expense.c.category_id, func.sum(expense.c.amount))
+        .select_from(expense.join(budget, expense.c.budget_id == budget.c.id))
+        .where(budget.c.family_id == family_id)
+        .group_by(budget.c.year, budget.c.month, expense.c.category_id)
+    )
+    archived_rows = connection.execute(
+        select(budget.c.year, budget.c.month, archived.c.category_id, func.sum(archived.c.total_amount))
+        .select_from(archived.join(budget, archived.c.budget_id == budget.c.id))
+        .where(budget.c.family_id == family_id, archived.c.entry_type == "expense")
+        .group_by(budget.c.year, budget.c.month, archived.c.category_id)
+    )
+    for year, month, category_id, total in list(live) + list(archived_rows):
+        key = (year, month, category_id)
+        monthly[key] = monthly.get(key, 0) + float(total)
+
+    if not monthly:
+        return {"months": [], "total": _series([]), "categories": {}}
+
+    months = _month_axis(min(key[:2] for key in monthly), max(key[:2] for key in monthly))
+    names = dict(connection.execute(select(category.c.id, category.c.name).where(category.c.family_id == family_id)).all())
+
+    amounts_by_category = {}
+    for category_id, amount in connection.execute(
+        select(expense.c.category_id, expense.c.amount)
+        .select_from(expense.join(budget, expense.c.budget_id == budget.c.id))
+        .where(budget.c.family_id == family_id)
+    ):
+        amounts_by_category.setdefault(category_id, []).append(float(amount))
+
+    categories = {}
+    for category_id in sorted({key[2] for key in monthly}):
+        values = [round(monthly.get((year, month, category_id), 0.0), 2) for year, month in months]
+        amounts = sorted(amounts_by_category.get(category_id, []))
+        categories[str(category_id)] = {
+            "name": names.get(category_id),
+            **_series(values),
+            "percentiles": {f"p{percent}": _percentile(amounts, percent) for percent in PERCENTILES}
+        }
+
+    totals = [round(sum(categories[key]["monthly"][index] for key in categories), 2) for index in range(len(months))]
+    return {
+        "months": [f"{year}-{month:02d}" for year, month in months],
+        "total": _series(totals),
+        "categories": categories
+    }
+
+def store_trend_cube(connection, family_id):
+    """Compute one family's cube and replace its stored statistics, return the timing in ms."""
+    started = time.perf_counter()
+    stats = FamilyTrendStats.__table__
+    cube = build_trend_cube(connection, family_id)
+    duration_ms = int((time.perf_counter() - started) * 1000)
+    connection.execute(stats.delete().where(stats.c.family_id == family_id))
+    connection.execute(stats.insert().values(family_id=family_id, data=cube, duration_ms=duration_ms,
+                                             computed_at=datetime.datetime.utcnow()))
+    return duration_ms
+
+def rollup_family(family_id):
+    """Worker entry point: compute and store one family's cube, return its timing."""
+    with _worker_engine.begin() as connection:
+        return family_id, store_trend_cube(connection, family_id)
+
+def _rollup_trends_params(params):
+    if params:
+        raise ValueError("rollup_trends takes no params")
+    return {}
+
+@job_handler("rollup_trends", public_params=_rollup_trends_params)
+def _rollup_trends_job(context):
+    """Refresh one family's trends outside the nightly run, e.g. after a large import."""
+    return {"duration_ms": store_trend_cube(db.session.connection(), context.family_id)}
+
+@click.command("rollup-trends")
+@click.option("--workers", type=int, default=os.cpu_count(), show_default=True,
+              help="Worker processes; each holds at most one DB connection.")
+@click.option("--restart", is_flag=True, help="Ignore an interrupted run and recompute every family.")
+@with_appcontext
+def rollup_trends_command(workers, restart):
+    """Nightly maintenance: rebuild every family's trend statistics, purge expired idempotency keys
+    and sweep receipt files no attachment refers to anymore."""
+    run = RollupRun.query.filter(RollupRun.finished_at.is_(None)).order_by(RollupRun.id.desc()).first()
+    if run and not restart:
+        click.echo(f"Resuming run {run.id} started at {run.started_at.isoformat()}")
+    else:
+        run = RollupRun()
+        db.session.add(run)
+        db.session.commit()
+
+    run_id = run.id
+    # Families already rolled up since this run started were finished before an interruption
+    done = select(FamilyTrendStats.family_id).where(FamilyTrendStats.computed_at >= run.started_at)
+    family_ids = list(db.session.scalars(select(Family.id).where(Family.id.notin_(done)).order_by(Family.id)))
+    click.echo(f"Rolling up {len(family_ids)} families with {workers} workers")
+
+    started = time.perf_counter()
+    failures = 0
+    database_uri = current_app.config["SQLALCHEMY_DATABASE_URI"]
+    db.session.close()
+    db.engine.dispose() # Do not let forked workers inherit pooled connections
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(database_uri,)) as pool:
+        futures = {pool.submit(rollup_family, family_id): family_id for family_id in family_ids}
+        for future in as_completed(futures):
+            try:
+                family_id, duration_ms = future.result()
+                click.echo(f"family {family_id}: {duration_ms} ms")
+            except Exception as e:
+                failures += 1
+                click.echo(f"family {futures[future]}: failed: {e}", err=True)
+
+    run = db.session.get(RollupRun, run_id)
+    run.family_count += len(family_ids) - failures
+    if not failures:
+        run.finished_at = datetime.datetime.utcnow()
+    purged = IdempotencyKey.purge_expired()
+    db.session.commit()
+    swept = sweep_unreferenced_blobs()
+
+    click.echo(f"Done in {time.perf_counter() - started:.1f}s, {failures} failed, {purged} expired idempotency keys purged, "
+               f"{swept} unreferenced receipt files removed")
+    if failures:
+        raise SystemExit(1)
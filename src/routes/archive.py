@@ -0,0 +1,69 @@
+from flask import Blueprint, request, jsonify
+from flask_login import login_required, current_user
+from src.models.user import db, Family, BudgetYearArchive
+from src.archive import ArchiveConflict, archive_family_year, restore_family_year
+
+archive_bp = Blueprint("archive_bp", __name__)
+
+@archive_bp.route("/archive", methods=["GET"])
+@login_required
+def list_archives():
+    family_id = request.args.get("family_id", type=int)
+    if not family_id:
+        return jsonify({"error": "family_id is required"}), 400
+    if not Family.for_member(family_id, current_user):
+        return jsonify({"error": "User not authorized for this family or family not found"}), 403
+
+    archives = BudgetYearArchive.query.filter_by(family_id=family_id).order_by(BudgetYearArchive.year.desc()).all()
+    return jsonify([archive.to_dict() for archive in archives]), 200
+
+@archive_bp.route("/archive", methods=["POST"])
+@login_required
+def archive_year():
+    data = request.get_json()
+    try:
+        for field in ["family_id", "year"]:
+            if field not in data:
+                return jsonify({"error": f"Missing required field: {field}"}), 400
+        if not Family.for_member(data["family_id"], current_user):
+            return jsonify({"error": "User not authorized for this family or family not found"}), 403
+
+        # Add logic to check if current_user has admin role for this family if needed
+
+        result = archive_family_year(data["family_id"], int(data["year"]))
+        if not result:
+            return jsonify({"error": "Nothing to archive for this year"}), 404
+        db.session.commit()
+        return jsonify(result), 200
+
+    except ValueError as ve:
+        return jsonify({"error": f"Invalid data format: {str(ve)}"}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500
+
+@archive_bp.route("/archive/restore", methods=["POST"])
+@login_required
+def restore_year():
+    data = request.get_json()
+    try:
+        for field in ["family_id", "year"]:
+            if field not in data:
+                return jsonify({"error": f"Missing required field: {field}"}), 400
+        if not Family.for_member(data["family_id"], current_user):
+            return jsonify({"error": "User not authorized for this family or family not found"}), 403
+
+        result = restore_family_year(data["family_id"], int(data["year"]))
+        if not result:
+            return jsonify({"error": "No archive found for this year"}), 404
+        db.session.commit()
+        return jsonify(result), 200
+
+    except ArchiveConflict as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 409
+    except ValueError as ve:
+        return jsonify({"error": f"Invalid data format: {str(ve)}"}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500
@@ -0,0 +1,150 @@
+import os
+import datetime
+from flask import Blueprint, request, jsonify, send_file
+from flask_login import login_required, current_user
+from src.models.user import db, Expense, Budget, Family, ExpenseAttachment, ChangeLog, Job
+from src.attachments import (MAX_ATTACHMENT_SIZE, THUMBNAIL_QUEUE_TIMEOUT, blob_path, thumbnail_path, has_thumbnail,
+                             thumbnail_supported, thumbnails_enabled, store_stream)
+from src.jobs import enqueue
+
+attachments_bp = Blueprint("attachments_bp", __name__)
+
+# Stored files never change under a given attachment id, so clients may cache them for good
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+def _load_attachment(attachment_id):
+    attachment = db.session.get(ExpenseAttachment, attachment_id)
+    if not attachment or not Family.for_member(attachment.family_id, current_user):
+        return None
+    return attachment
+
+def _send_stored_file(path, mimetype, etag, download_name):
+    if not os.path.exists(path):
+        return jsonify({"error": "File not found"}), 404
+    # conditional=True answers Range and If-None-Match requests; full responses go through
+    # the server's wsgi.file_wrapper (sendfile) instead of being copied through Python
+    response = send_file(path, mimetype=mimetype, download_name=download_name, conditional=True,
+                         etag=etag, max_age=IMMUTABLE_MAX_AGE)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
+
+def _enqueue_thumbnail(attachment):
+    job = enqueue("attachment_thumbnail", attachment.family_id, current_user.id, {"sha256": attachment.sha256})
+    db.session.flush()
+    attachment.thumbnail_job_id = job.id
+    return job
+
+@attachments_bp.route("/expense/<int:expense_id>/attachments", methods=["POST"])
+@login_required
+def upload_attachment(expense_id):
+    expense = Expense.query.get_or_404(expense_id)
+    budget = Budget.query.get(expense.budget_id)
+    family = Family.for_member(budget.family_id, current_user)
+    if not family:
+        return jsonify({"error": "User not authorized for this expense"}), 403
+    if request.content_length and request.content_length > MAX_ATTACHMENT_SIZE + 64 * 1024: # Room for multipart framing
+        return jsonify({"error": f"Attachments are limited to {MAX_ATTACHMENT_SIZE // (1024 * 1024)} MB"}), 413
+
+    try:
+        # Either a multipart form with a "file" field, or the raw file as the request body
+        if request.mimetype == "multipart/form-data":
+            upload = request.files.get("file")
+            if not upload:
+                return jsonify({"error": "Missing required field: file"}), 400
+            stream, filename = upload.stream, upload.filename
+        else:
+            stream, filename = request.stream, request.args.get("filename")
+
+        sha256, size, content_type = store_stream(stream)
+        attachment = ExpenseAttachment(
+            family_id=family.id,
+            expense_id=expense.id,
+            sha256=sha256,
+            filename=os.path.basename(filename)[:255] if filename else None,
+            content_type=content_type,
+            size=size,
+            created_by_user_id=current_user.id
+        )
+        db.session.add(attachment)
+        db.session.flush()
+        ChangeLog.record(family.id, "attachment", attachment.id, "create", attachment.to_dict(), current_user.id)
+        if has_thumbnail(content_type) and not os.path.exists(thumbnail_path(sha256)):
+            _enqueue_thumbnail(attachment)
+        db.session.commit()
+        return jsonify(attachment.to_dict()), 201
+
+    except ValueError as ve:
+        db.session.rollback()
+        return jsonify({"error": f"Invalid data format: {str(ve)}"}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500
+
+@attachments_bp.route("/expense/<int:expense_id>/attachments", methods=["GET"])
+@login_required
+def list_attachments(expense_id):
+    expense = Expense.query.get_or_404(expense_id)
+    budget = Budget.query.get(expense.budget_id)
+    if not Family.for_member(budget.family_id, current_user):
+        return jsonify({"error": "User not authorized for this expense"}), 403
+
+    attachments = (ExpenseAttachment.query.filter_by(expense_id=expense.id, family_id=budget.family_id)
+                   .order_by(ExpenseAttachment.id).all())
+    return jsonify([attachment.to_dict() for attachment in attachments]), 200
+
+@attachments_bp.route("/attachments/<int:attachment_id>", methods=["GET"])
+@login_required
+def download_attachment(attachment_id):
+    attachment = _load_attachment(attachment_id)
+    if not attachment:
+        return jsonify({"error": "Attachment not found or user not authorized"}), 404
+    return _send_stored_file(blob_path(attachment.sha256), attachment.content_type, attachment.sha256,
+                             attachment.filename or attachment.sha256)
+
+@attachments_bp.route("/attachments/<int:attachment_id>/thumbnail", methods=["GET"])
+@login_required
+def download_thumbnail(attachment_id):
+    attachment = _load_attachment(attachment_id)
+    if not attachment:
+        return jsonify({"error": "Attachment not found or user not authorized"}), 404
+    if not thumbnail_supported(attachment.content_type):
+        return jsonify({"error": "Thumbnails are only rendered for JPEG, PNG, GIF and WebP images"}), 415
+
+    path = thumbnail_path(attachment.sha256)
+    if os.path.exists(path):
+        return _send_stored_file(path, "image/jpeg", f"{attachment.sha256}-thumbnail", f"{attachment.sha256}.jpg")
+    if not thumbnails_enabled():
+        return jsonify({"error": "Thumbnails are not available, Pillow is not installed"}), 404
+
+    job = db.session.get(Job, attachment.thumbnail_job_id) if attachment.thumbnail_job_id else None
+    if job and job.status == "failed":
+        return jsonify({"status": "failed", "error": f"Thumbnail could not be rendered: {job.error}"}), 404
+    if job and job.status == "queued" and job.created_at < datetime.datetime.utcnow() - THUMBNAIL_QUEUE_TIMEOUT:
+        return jsonify({"status": "queued", "error": "No job worker has picked up the thumbnail"}), 503, {"Retry-After": "30"}
+    if not job or job.status not in ("queued", "running"):
+        # Never queued, cancelled, or rendered once and removed since: render it again
+        try:
+            job = _enqueue_thumbnail(attachment)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            return jsonify({"error": str(e)}), 500
+    return jsonify({"status": job.status, "job_id": job.id}), 202, {"Retry-After": "2"}
+
+@attachments_bp.route("/attachments/<int:attachment_id>", methods=["DELETE"])
+@login_required
+def delete_attachment(attachment_id):
+    attachment = _load_attachment(attachment_id)
+    if not attachment:
+        return jsonify({"error": "Attachment not found or user not authorized"}), 404
+    try:
+        # The stored file may be shared with other attachments; the nightly sweep removes it once unused
+        ChangeLog.record(attachment.family_id, "attachment", attachment.id, "delete", None, current_user.id)
+        db.session.delete(attachment)
+        db.session.commit()
+        return jsonify({"message": "Attachment deleted successfully"}), 200
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500
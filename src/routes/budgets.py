@@ -0,0 +1,222 @@
+from flask import Blueprint, request, jsonify
+from flask_login import login_required, current_user
+from src.models.user import db, Budget, Category, CategoryPlan, Family, ChangeLog, upsert
+from sqlalchemy import select, func, case, literal
+from sqlalchemy.orm import aliased
+from decimal import Decimal, InvalidOperation
+import datetime
+
+budget_bp = Blueprint("budget_bp", __name__)
+
+# Largest grid accepted in one call
+MAX_PLAN_YEARS = 10
+
+def _amount(value, field):
+    try:
+        amount = Decimal(str(value)).quantize(Decimal("0.01"))
+    except (InvalidOperation, TypeError):
+        raise ValueError(f"{field} must be a number")
+    if amount < 0:
+        raise ValueError(f"{field} must not be negative")
+    return amount
+
+def _factor(value, field):
+    try:
+        factor = Decimal(str(value))
+    except (InvalidOperation, TypeError):
+        raise ValueError(f"{field} must be a number")
+    if factor < 0:
+        raise ValueError(f"{field} must not be negative")
+    return factor
+
+def _check_categories(family_id, category_ids):
+    """Raise ValueError unless every id is a category of the family (one query)."""
+    if not category_ids:
+        return
+    found = set(db.session.scalars(select(Category.id).where(Category.family_id == family_id,
+                                                             Category.id.in_(category_ids))))
+    missing = sorted(set(category_ids) - found)
+    if missing:
+        raise ValueError(f"Categories not found for this family: {missing}")
+
+def _budget_ids(family_id, years):
+    return set(db.session.scalars(select(Budget.id).where(Budget.family_id == family_id, Budget.year.in_(years))))
+
+def _record_budget_changes(family_id, budgets, existing_ids):
+    """Log each budget with its category plans; budgets missing from existing_ids were created by this call."""
+    category_plans = {}
+    for budget_id, category_id, amount in db.session.execute(
+            select(CategoryPlan.budget_id, CategoryPlan.category_id, CategoryPlan.planned_amount)
+            .where(CategoryPlan.budget_id.in_([budget.id for budget in budgets]))):
+        category_plans.setdefault(budget_id, {})[str(category_id)] = float(amount)
+    for budget in budgets:
+        action = 'update' if budget.id in existing_ids else 'create'
+        data = {**budget.to_dict(), "category_plans": category_plans.get(budget.id, {})}
+        ChangeLog.record(family_id, 'budget', budget.id, action, data, current_user.id)
+
+@budget_bp.route("/budget/plan", methods=["GET"])
+@login_required
+def get_budget_plan():
+    family_id = request.args.get("family_id", type=int)
+    start_year = request.args.get("start_year", type=int, default=datetime.date.today().year)
+    end_year = request.args.get("end_year", type=int, default=start_year)
+
+    if not family_id:
+        return jsonify({"error": "family_id is required"}), 400
+    if end_year < start_year or end_year - start_year >= MAX_PLAN_YEARS:
+        return jsonify({"error": f"end_year must be within {MAX_PLAN_YEARS} years from start_year"}), 400
+    if not Family.for_member(family_id, current_user):
+        return jsonify({"error": "User not authorized for this family or family not found"}), 403
+
+    # Budgets and their category plans in one outer join, laid onto a zero-filled month grid
+    rows = db.session.execute(
+        select(Budget.id, Budget.year, Budget.month, Budget.planned_amount,
+               CategoryPlan.category_id, CategoryPlan.planned_amount)
+        .outerjoin(CategoryPlan, CategoryPlan.budget_id == Budget.id)
+        .where(Budget.family_id == family_id, Budget.year.between(start_year, end_year))
+    )
+    grid = {
+        (year, month): {"year": year, "month": month, "budget_id": None, "planned_amount": 0.0, "categories": {}}
+        for year in range(start_year, end_year + 1) for month in range(1, 13)
+    }
+    for budget_id, year, month, planned_amount, category_id, category_amount in rows:
+        cell = grid[(year, month)]
+        cell["budget_id"] = budget_id
+        cell["planned_amount"] = float(planned_amount)
+        if category_id is not None:
+            cell["categories"][str(category_id)] = float(category_amount)
+
+    return jsonify({
+        "family_id": family_id,
+        "start_year": start_year,
+        "end_year": end_year,
+        "months": [grid[key] for key in sorted(grid)]
+    }), 200
+
+@budget_bp.route("/budget/plan", methods=["PUT"])
+@login_required
+def update_budget_plan():
+    data = request.get_json()
+    try:
+        family_id = int(data["family_id"])
+        if not Family.for_member(family_id, current_user):
+            return jsonify({"error": "User not authorized for this family or family not found"}), 403
+
+        cells = {}
+        for entry in data.get("months") or []:
+            year, month = int(entry["year"]), int(entry["month"])
+            if not 1 <= month <= 12:
+                raise ValueError(f"Invalid month {month}")
+            cell = cells.setdefault((year, month), {"planned_amount": None, "categories": {}})
+            if entry.get("planned_amount") is not None:
+                cell["planned_amount"] = _amount(entry["planned_amount"], f"planned_amount of {month}/{year}")
+            for category_id, amount in (entry.get("categories") or {}).items():
+                cell["categories"][int(category_id)] = _amount(amount, f"category {category_id} of {month}/{year}")
+        if not cells:
+            raise ValueError("months must list at least one month")
+        if len({year for year, _ in cells}) > MAX_PLAN_YEARS:
+            raise ValueError(f"At most {MAX_PLAN_YEARS} years can be planned in one call")
+        _check_categories(family_id, {category_id for cell in cells.values() for category_id in cell["categories"]})
+
+        years = {year for year, _ in cells}
+        existing_ids = _budget_ids(family_id, years)
+        now = datetime.datetime.utcnow()
+        budget_table = Budget.__table__
+        conflict = ["family_id", "year", "month"]
+        planned = [{"family_id": family_id, "year": year, "month": month, "planned_amount": cell["planned_amount"],
+                    "created_at": now, "updated_at": now}
+                   for (year, month), cell in cells.items() if cell["planned_amount"] is not None]
+        # Months that only carry category plans still need their budget row, without touching its amount
+        unplanned = [{"family_id": family_id, "year": year, "month": month, "planned_amount": 0,
+                      "created_at": now, "updated_at": now}
+                     for (year, month), cell in cells.items() if cell["planned_amount"] is None]
+        if planned:
+            upsert(budget_table, conflict, ["planned_amount", "updated_at"], values=planned)
+        if unplanned:
+            upsert(budget_table, conflict, values=unplanned)
+
+        budgets = (Budget.query.filter(Budget.family_id == family_id, Budget.year.in_(years))
+                   .populate_existing().all())
+        budgets = [budget for budget in budgets if (budget.year, budget.month) in cells]
+        budget_ids = {(budget.year, budget.month): budget.id for budget in budgets}
+
+        category_rows = [{"budget_id": budget_ids[key], "category_id": category_id, "planned_amount": amount,
+                          "updated_at": now}
+                         for key, cell in cells.items() for category_id, amount in cell["categories"].items()]
+        if category_rows:
+            upsert(CategoryPlan.__table__, ["budget_id", "category_id"], ["planned_amount", "updated_at"],
+                   values=category_rows)
+
+        _record_budget_changes(family_id, budgets, existing_ids)
+        db.session.commit()
+        return jsonify({"months": len(budgets), "category_plans": len(category_rows)}), 200
+    except (KeyError, TypeError, ValueError) as e:
+        db.session.rollback()
+        return jsonify({"error": f"Invalid data format: {str(e)}"}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500
+
+@budget_bp.route("/budget/plan/copy_forward", methods=["POST"])
+@login_required
+def copy_budget_plan_forward():
+    """Copy a year's plans onto another year, scaled by factor and optional per-category factors."""
+    data = request.get_json()
+    try:
+        family_id = int(data["family_id"])
+        if not Family.for_member(family_id, current_user):
+            return jsonify({"error": "User not authorized for this family or family not found"}), 403
+
+        from_year = int(data["from_year"])
+        to_year = int(data.get("to_year", from_year + 1))
+        if to_year == from_year:
+            raise ValueError("to_year must differ from from_year")
+        factor = _factor(data.get("factor", 1), "factor")
+        category_factors = {int(category_id): _factor(value, f"factor of category {category_id}")
+                            for category_id, value in (data.get("category_factors") or {}).items()}
+        category_ids = [int(category_id) for category_id in data["category_ids"]] if data.get("category_ids") else None
+        include_categories = bool(data.get("include_categories", True))
+        _check_categories(family_id, set(category_factors) | set(category_ids or []))
+
+        existing_ids = _budget_ids(family_id, [to_year])
+        now = datetime.datetime.utcnow()
+        # Budgets: one INSERT ... SELECT from the source year, overwriting months already planned
+        source = select(literal(family_id), literal(to_year), Budget.month,
+                        func.round(Budget.planned_amount * literal(factor), 2), literal(now), literal(now)) \
+            .where(Budget.family_id == family_id, Budget.year == from_year)
+        upsert(Budget.__table__, ["family_id", "year", "month"], ["planned_amount", "updated_at"],
+               from_select=(["family_id", "year", "month", "planned_amount", "created_at", "updated_at"], source))
+
+        category_plans = 0
+        if include_categories:
+            source_budget = aliased(Budget)
+            target_budget = aliased(Budget)
+            category_factor = case(
+                *[(CategoryPlan.category_id == category_id, literal(value)) for category_id, value in category_factors.items()],
+                else_=literal(factor)
+            ) if category_factors else literal(factor)
+            plans = (select(target_budget.id, CategoryPlan.category_id,
+                            func.round(CategoryPlan.planned_amount * category_factor, 2), literal(now))
+                     .join(source_budget, source_budget.id == CategoryPlan.budget_id)
+                     .join(target_budget, (target_budget.family_id == source_budget.family_id)
+                           & (target_budget.month == source_budget.month) & (target_budget.year == to_year))
+                     .where(source_budget.family_id == family_id, source_budget.year == from_year))
+            if category_ids:
+                plans = plans.where(CategoryPlan.category_id.in_(category_ids))
+            category_plans = db.session.scalar(select(func.count()).select_from(plans.subquery()))
+            upsert(CategoryPlan.__table__, ["budget_id", "category_id"], ["planned_amount", "updated_at"],
+                   from_select=(["budget_id", "category_id", "planned_amount", "updated_at"], plans))
+
+        source_months = select(Budget.month).where(Budget.family_id == family_id, Budget.year == from_year)
+        budgets = (Budget.query.filter(Budget.family_id == family_id, Budget.year == to_year,
+                                       Budget.month.in_(source_months))
+                   .populate_existing().all())
+        _record_budget_changes(family_id, budgets, existing_ids)
+        db.session.commit()
+        return jsonify({"months": len(budgets), "category_plans": category_plans}), 200
+    except (KeyError, TypeError, ValueError) as e:
+        db.session.rollback()
+        return jsonify({"error": f"Invalid data format: {str(e)}"}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500
@@ -0,0 +1,33 @@
+from flask import Blueprint, request, jsonify
+from flask_login import login_required, current_user
+from src.models.user import ChangeLog, Family
+
+changes_bp = Blueprint("changes_bp", __name__)
+
+@changes_bp.route("/changes", methods=["GET"])
+@login_required
+def get_changes():
+    family_id = request.args.get("family_id", type=int)
+    since = request.args.get("since", type=int, default=0) # Cursor returned by the previous call
+    limit = min(request.args.get("limit", type=int, default=500), 1000)
+
+    if not family_id:
+        return jsonify({"error": "family_id is required"}), 400
+
+    if not Family.for_member(family_id, current_user):
+        return jsonify({"error": "User not authorized for this family or family not found"}), 403
+
+    # Served straight from the (family_id, seq) index; one extra row tells us if there is more
+    entries = (ChangeLog.query
+               .filter(ChangeLog.family_id == family_id, ChangeLog.seq > since)
+               .order_by(ChangeLog.seq)
+               .limit(limit + 1)
+               .all())
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+
+    return jsonify({
+        "changes": [entry.to_dict() for entry in entries],
+        "cursor": entries[-1].seq if entries else since,
+        "has_more": has_more
+    }), 200
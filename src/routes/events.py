@@ -0,0 +1,47 @@
+from flask import Blueprint, request, jsonify, Response
+from flask_login import login_required, current_user
+from src.models.user import db, Family
+from src.events import broadcaster
+import json
+import queue
+
+events_bp = Blueprint("events_bp", __name__)
+
+# Seconds between keep-alive comments, keeps proxies from closing idle streams
+KEEPALIVE_INTERVAL = 15
+
+@events_bp.route("/events", methods=["GET"])
+@login_required
+def stream_family_events():
+    family_id = request.args.get("family_id", type=int)
+    if not family_id:
+        return jsonify({"error": "family_id is required"}), 400
+
+    if not Family.for_member(family_id, current_user):
+        return jsonify({"error": "User not authorized for this family or family not found"}), 403
+
+    # The stream can stay open for hours, give the connection back to the pool now
+    db.session.close()
+
+    # Each stream pins a server thread; past the cap clients fall back to polling /api/changes
+    subscriber = broadcaster.subscribe(family_id)
+    if subscriber is None:
+        return jsonify({"error": "Too many open event streams, poll /api/changes instead"}), 503, {"Retry-After": "30"}
+
+    def generate():
+        yield "retry: 5000\n\n"
+        while True:
+            try:
+                event = subscriber.get(timeout=KEEPALIVE_INTERVAL)
+            except queue.Empty:
+                yield ": keepalive\n\n"
+                continue
+            yield f"event: update\ndata: {json.dumps(event, separators=(',', ':'))}\n\n"
+
+    response = Response(generate(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+    # Also runs when the client disconnects before the first chunk
+    response.call_on_close(lambda: broadcaster.unsubscribe(family_id, subscriber))
+    return response
@@ -0,0 +1,72 @@
+from flask import Blueprint, request, jsonify, url_for
+from flask_login import login_required, current_user
+from src.models.user import db, Family, Job
+from src.jobs import enqueue, public_job_params, request_cancel, FINISHED_STATUSES
+
+jobs_bp = Blueprint("jobs_bp", __name__)
+
+def _load_job(job_id):
+    job = db.session.get(Job, job_id)
+    if not job or not Family.for_member(job.family_id, current_user):
+        return None
+    return job
+
+@jobs_bp.route("/jobs", methods=["POST"])
+@login_required
+def create_job():
+    data = request.get_json()
+    try:
+        for field in ["family_id", "kind"]:
+            if field not in data:
+                return jsonify({"error": f"Missing required field: {field}"}), 400
+        if not Family.for_member(data["family_id"], current_user):
+            return jsonify({"error": "User not authorized for this family or family not found"}), 403
+
+        params = data.get("params") or {}
+        if not isinstance(params, dict):
+            raise ValueError("params must be an object")
+        job = enqueue(data["kind"], data["family_id"], current_user.id, public_job_params(data["kind"], params))
+        db.session.commit()
+        return jsonify(job.to_dict()), 202, {"Location": url_for("jobs_bp.get_job", job_id=job.id)}
+
+    except (KeyError, TypeError, ValueError) as ve:
+        db.session.rollback()
+        return jsonify({"error": f"Invalid data format: {str(ve)}"}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500
+
+@jobs_bp.route("/jobs", methods=["GET"])
+@login_required
+def list_jobs():
+    family_id = request.args.get("family_id", type=int)
+    limit = min(request.args.get("limit", type=int, default=50), 200)
+    if not family_id:
+        return jsonify({"error": "family_id is required"}), 400
+    if not Family.for_member(family_id, current_user):
+        return jsonify({"error": "User not authorized for this family or family not found"}), 403
+
+    jobs = Job.query.filter_by(family_id=family_id).order_by(Job.id.desc()).limit(limit).all()
+    return jsonify([job.to_dict() for job in jobs]), 200
+
+@jobs_bp.route("/jobs/<int:job_id>", methods=["GET"])
+@login_required
+def get_job(job_id):
+    job = _load_job(job_id)
+    if not job:
+        return jsonify({"error": "Job not found or user not authorized"}), 404
+    return jsonify(job.to_dict()), 200
+
+@jobs_bp.route("/jobs/<int:job_id>/cancel", methods=["POST"])
+@login_required
+def cancel_job(job_id):
+    job = _load_job(job_id)
+    if not job:
+        return jsonify({"error": "Job not found or user not authorized"}), 404
+    if job.status in FINISHED_STATUSES:
+        return jsonify({"error": f"Job already {job.status}"}), 409
+
+    # A running job stops at its next progress report; the status turns to cancelled then
+    request_cancel(job)
+    db.session.commit()
+    return jsonify(job.to_dict()), 202
@@ -1,13 +1,16 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, url_for
 from flask_login import login_required, current_user
-from src.models.user import db, RecurringExpense, Expense, Budget, Category, PaymentType, Family
+from src.models.user import db, RecurringExpense, Expense, Budget, Category, PaymentType, Family, ChangeLog
 import datetime
 from dateutil.relativedelta import relativedelta
+from src.idempotency import idempotent
+from src.jobs import job_handler, enqueue
 
 recurring_expense_bp = Blueprint("recurring_expense_bp", __name__)
 
 @recurring_expense_bp.route("/recurring_expense", methods=["POST"])
 @login_required
+@idempotent
 def add_recurring_expense():
     data = request.get_json()
     try:
@@ -29,7 +32,7 @@ def add_recurring_expense():
 
         subcategory_id = data.get("subcategory_id")
         if subcategory_id:
-            subcategory = Category.query.filter_by(id=subcategory_id, family_id=data["family_id"], parent_id=data["category_id"]).first()
+            subcategory = Category.find_descendant(data["family_id"], data["category_id"], subcategory_id)
             if not subcategory:
                 return jsonify({"error": "Subcategory not found or invalid"}), 400
         
@@ -67,6 +70,9 @@ def add_recurring_expense():
             updated_by_user_id=current_user.id
         )
         db.session.add(new_recurring_expense)
+        db.session.flush()
+        ChangeLog.record(family.id, "recurring_expense", new_recurring_expense.id, "create",
+                         new_recurring_expense.to_dict(), current_user.id)
         db.session.commit()
         return jsonify({"message": "Recurring expense rule added successfully", "recurring_expense_id": new_recurring_expense.id}), 201
 
@@ -99,13 +105,12 @@ def update_recurring_expense(rule_id):
             if data["subcategory_id"] is None:
                 rule.subcategory_id = None
             else:
-                subcategory = Category.query.filter_by(id=data["subcategory_id"], family_id=family.id, parent_id=rule.category_id).first()
+                subcategory = Category.find_descendant(family.id, rule.category_id, data["subcategory_id"])
                 if not subcategory:
                     return jsonify({"error": "Subcategory not found or invalid"}), 400
                 rule.subcategory_id = data["subcategory_id"]
         elif "category_id" in data and rule.subcategory_id is not None:
-            current_subcategory = Category.query.get(rule.subcategory_id)
-            if current_subcategory and current_subcategory.parent_id != rule.category_id:
+            if not Category.find_descendant(family.id, rule.category_id, rule.subcategory_id):
                 rule.subcategory_id = None
 
         if "payment_type_id" in data:
@@ -125,6 +130,7 @@ def update_recurring_expense(rule_id):
         
         rule.updated_at = datetime.datetime.utcnow()
         rule.updated_by_user_id = current_user.id
+        ChangeLog.record(family.id, "recurring_expense", rule.id, "update", rule.to_dict(), current_user.id)
         
         db.session.commit()
         return jsonify({"message": "Recurring expense rule updated successfully", "rule_id": rule.id}), 200
@@ -147,6 +153,7 @@ def delete_recurring_expense(rule_id):
     # Add logic to check if current_user has admin role for this family if needed
 
     try:
+        ChangeLog.record(family.id, "recurring_expense", rule.id, "delete", None, current_user.id)
         db.session.delete(rule)
         db.session.commit()
         return jsonify({"message": "Recurring expense rule deleted successfully"}), 200
@@ -154,8 +161,136 @@ def delete_recurring_expense(rule_id):
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
 
+# Ranges longer than this are generated by a background job and answered with 202
+INLINE_GENERATION_MONTHS = 3
+
+def _months_between(first, last):
+    months = []
+    current = datetime.date(first[0], first[1], 1)
+    while current <= datetime.date(last[0], last[1], 1):
+        months.append((current.year, current.month))
+        current += relativedelta(months=1)
+    return months
+
+def generate_recurring_expenses(family_id, year, month, user_id):
+    """Book the family's recurring expenses falling in one month; returns how many were added.
+
+    Occurrences already booked are skipped, so running it again is harmless. Runs in the
+    caller's transaction; the caller commits.
+    """
+    budget = Budget.find_or_create(family_id, year, month)
+
+    rules = RecurringExpense.query.filter_by(family_id=family_id).all()
+    generated_count = 0
+    generated_expenses = []
+
+    # Occurrences already booked this month, loaded once instead of one lookup per occurrence
+    existing_occurrences = set(
+        db.session.query(Expense.description, Expense.amount, Expense.expense_date)
+        .filter(Expense.budget_id == budget.id, Expense.description.like("Recurring: %"))
+        .all()
+    )
+
+    first_day_of_month = datetime.date(year, month, 1)
+    if month == 12:
+        last_day_of_month = datetime.date(year, month, 31)
+    else:
+        last_day_of_month = datetime.date(year, month + 1, 1) - datetime.timedelta(days=1)
+
+    for rule in rules:
+        if rule.start_date > last_day_of_month or (rule.end_date and rule.end_date < first_day_of_month):
+            continue # Rule is not active in this month
+
+        current_date = rule.start_date
+        if rule.recurrence_type == "monthly":
+            # Ensure day_of_month is valid for the target month
+            actual_day_of_month = min(rule.day_of_month, (datetime.date(year, month + 1, 1) - datetime.timedelta(days=1)).day if month < 12 else 31)
+            expense_date_for_month = datetime.date(year, month, actual_day_of_month)
+            if (first_day_of_month <= expense_date_for_month <= last_day_of_month and
+               rule.start_date <= expense_date_for_month and
+               (not rule.end_date or expense_date_for_month <= rule.end_date)):
+                # Check if expense already exists for this rule and date
+                occurrence = (f"Recurring: {rule.description}", rule.amount, expense_date_for_month)
+                if occurrence not in existing_occurrences:
+                    existing_occurrences.add(occurrence)
+                    new_expense = Expense(
+                        budget_id=budget.id,
+                        category_id=rule.category_id,
+                        subcategory_id=rule.subcategory_id,
+                        payment_type_id=rule.payment_type_id,
+                        description=f"Recurring: {rule.description}",
+                        amount=rule.amount,
+                        expense_date=expense_date_for_month,
+                        created_by_user_id=user_id,
+                        updated_by_user_id=user_id
+                    )
+                    db.session.add(new_expense)
+                    generated_expenses.append(new_expense)
+                    generated_count += 1
+
+        elif rule.recurrence_type in ["weekly", "biweekly"]:
+            interval = 1 if rule.recurrence_type == "weekly" else 2
+            # Find the first occurrence in or after the rule's start_date
+            temp_date = rule.start_date
+            while temp_date.weekday() != rule.day_of_week:
+                temp_date += datetime.timedelta(days=1)
+
+            # For biweekly, adjust if the first found date is in the wrong week of the 2-week cycle
+            if rule.recurrence_type == "biweekly":
+                # This simple bi-weekly might need a more robust anchor date if strict bi-weekly periods are needed
+                # For now, it's every 2 weeks from the first valid day_of_week on or after start_date
+                pass # Assuming start_date itself or first valid day_of_week after it is the anchor
+
+            current_occurrence_date = temp_date
+            while current_occurrence_date <= last_day_of_month:
+                if (current_occurrence_date >= first_day_of_month and
+                   (not rule.end_date or current_occurrence_date <= rule.end_date)):
+                    occurrence = (f"Recurring: {rule.description}", rule.amount, current_occurrence_date)
+                    if occurrence not in existing_occurrences:
+                        existing_occurrences.add(occurrence)
+                        new_expense = Expense(
+                            budget_id=budget.id,
+                            category_id=rule.category_id,
+                            subcategory_id=rule.subcategory_id,
+                            payment_type_id=rule.payment_type_id,
+                            description=f"Recurring: {rule.description}",
+                            amount=rule.amount,
+                            expense_date=current_occurrence_date,
+                            created_by_user_id=user_id,
+                            updated_by_user_id=user_id
+                        )
+                        db.session.add(new_expense)
+                        generated_expenses.append(new_expense)
+                        generated_count += 1
+                current_occurrence_date += datetime.timedelta(weeks=interval)
+
+    if generated_expenses:
+        db.session.flush()
+        for new_expense in generated_expenses:
+            ChangeLog.record(family_id, "expense", new_expense.id, "create", new_expense.to_dict(), user_id)
+    return generated_count
+
+def _generation_params(params):
+    months = {key: int(params[key]) for key in ("start_year", "start_month", "end_year", "end_month")}
+    if not (1 <= months["start_month"] <= 12 and 1 <= months["end_month"] <= 12):
+        raise ValueError("start_month and end_month must be between 1 and 12")
+    if not _months_between((months["start_year"], months["start_month"]), (months["end_year"], months["end_month"])):
+        raise ValueError("end_year/end_month must not be before start_year/start_month")
+    return months
+
+@job_handler("generate_recurring_expenses", public_params=_generation_params)
+def _generate_recurring_expenses_job(context, start_year, start_month, end_year, end_month):
+    months = _months_between((start_year, start_month), (end_year, end_month))
+    generated_count = 0
+    for index, (year, month) in enumerate(months):
+        generated_count += generate_recurring_expenses(context.family_id, year, month, context.user_id)
+        db.session.commit() # Finished months stay booked if the job is cancelled or restarted
+        context.progress((index + 1) * 100 / len(months))
+    return {"generated": generated_count, "months": len(months)}
+
 @recurring_expense_bp.route("/recurring_expense/generate", methods=["POST"])
 @login_required
+@idempotent
 def generate_recurring_expenses_for_month():
     data = request.get_json()
     try:
@@ -167,6 +302,11 @@ def generate_recurring_expenses_for_month():
         family_id = data["family_id"]
         year = int(data["year"])
         month = int(data["month"])
+        end_year = int(data.get("end_year", year))
+        end_month = int(data.get("end_month", month))
+        months = _months_between((year, month), (end_year, end_month))
+        if not months:
+            return jsonify({"error": "end_year/end_month must not be before year/month"}), 400
 
         family = Family.query.get(family_id)
         if not family or current_user not in family.members:
@@ -174,97 +314,18 @@ def generate_recurring_expenses_for_month():
         
         # Add logic to check if current_user has admin role for this family if needed for generation
 
-        budget = Budget.query.filter_by(family_id=family_id, year=year, month=month).first()
-        if not budget:
-            budget = Budget(family_id=family_id, year=year, month=month, planned_amount=0)
-            db.session.add(budget)
-            # db.session.commit() # Commit later with expenses
-
-        rules = RecurringExpense.query.filter_by(family_id=family_id).all()
-        generated_count = 0
-        
-        first_day_of_month = datetime.date(year, month, 1)
-        if month == 12:
-            last_day_of_month = datetime.date(year, month, 31)
-        else:
-            last_day_of_month = datetime.date(year, month + 1, 1) - datetime.timedelta(days=1)
-
-        for rule in rules:
-            if rule.start_date > last_day_of_month or (rule.end_date and rule.end_date < first_day_of_month):
-                continue # Rule is not active in this month
-
-            current_date = rule.start_date
-            if rule.recurrence_type == "monthly":
-                # Ensure day_of_month is valid for the target month
-                actual_day_of_month = min(rule.day_of_month, (datetime.date(year, month + 1, 1) - datetime.timedelta(days=1)).day if month < 12 else 31)
-                expense_date_for_month = datetime.date(year, month, actual_day_of_month)
-                if (first_day_of_month <= expense_date_for_month <= last_day_of_month and
-                   rule.start_date <= expense_date_for_month and
-                   (not rule.end_date or expense_date_for_month <= rule.end_date)):
-                    # Check if expense already exists for this rule and date
-                    exists = Expense.query.filter_by(
-                        budget_id=budget.id, 
-                        description=f"Recurring: {rule.description}", 
-                        amount=rule.amount, 
-                        expense_date=expense_date_for_month,
-                        # Could add a link to recurring_rule_id if model is extended
-                    ).first()
-                    if not exists:
-                        new_expense = Expense(
-                            budget_id=budget.id,
-                            category_id=rule.category_id,
-                            subcategory_id=rule.subcategory_id,
-                            payment_type_id=rule.payment_type_id,
-                            description=f"Recurring: {rule.description}",
-                            amount=rule.amount,
-                            expense_date=expense_date_for_month,
-                            created_by_user_id=current_user.id,
-                            updated_by_user_id=current_user.id
-                        )
-                        db.session.add(new_expense)
-                        generated_count += 1
-            
-            elif rule.recurrence_type in ["weekly", "biweekly"]:
-                interval = 1 if rule.recurrence_type == "weekly" else 2
-                # Find the first occurrence in or after the rule's start_date
-                temp_date = rule.start_date
-                while temp_date.weekday() != rule.day_of_week:
-                    temp_date += datetime.timedelta(days=1)
-                
-                # For biweekly, adjust if the first found date is in the wrong week of the 2-week cycle
-                if rule.recurrence_type == "biweekly":
-                    # This simple bi-weekly might need a more robust anchor date if strict bi-weekly periods are needed
-                    # For now, it's every 2 weeks from the first valid day_of_week on or after start_date
-                    pass # Assuming start_date itself or first valid day_of_week after it is the anchor
-
-                current_occurrence_date = temp_date
-                while current_occurrence_date <= last_day_of_month:
-                    if (current_occurrence_date >= first_day_of_month and
-                       (not rule.end_date or current_occurrence_date <= rule.end_date)):
-                        exists = Expense.query.filter_by(
-                            budget_id=budget.id, 
-                            description=f"Recurring: {rule.description}", 
-                            amount=rule.amount, 
-                            expense_date=current_occurrence_date
-                        ).first()
-                        if not exists:
-                            new_expense = Expense(
-                                budget_id=budget.id,
-                                category_id=rule.category_id,
-                                subcategory_id=rule.subcategory_id,
-                                payment_type_id=rule.payment_type_id,
-                                description=f"Recurring: {rule.description}",
-                                amount=rule.amount,
-                                expense_date=current_occurrence_date,
-                                created_by_user_id=current_user.id,
-                                updated_by_user_id=current_user.id
-                            )
-                            db.session.add(new_expense)
-                            generated_count += 1
-                    current_occurrence_date += datetime.timedelta(weeks=interval)
+        if len(months) > INLINE_GENERATION_MONTHS or data.get("background"):
+            job = enqueue("generate_recurring_expenses", family_id, current_user.id, {
+                "start_year": year, "start_month": month, "end_year": end_year, "end_month": end_month
+            })
+            db.session.commit()
+            return jsonify(job.to_dict()), 202, {"Location": url_for("jobs_bp.get_job", job_id=job.id)}
 
+        generated_count = sum(generate_recurring_expenses(family_id, y, m, current_user.id) for y, m in months)
         db.session.commit()
-        return jsonify({"message": f"{generated_count} recurring expenses generated for {month}/{year}"}), 200
+        if len(months) == 1:
+            return jsonify({"message": f"{generated_count} recurring expenses generated for {month}/{year}"}), 200
+        return jsonify({"message": f"{generated_count} recurring expenses generated for {month}/{year} to {end_month}/{end_year}"}), 200
 
     except ValueError as ve:
         return jsonify({"error": f"Invalid data format: {str(ve)}"}), 400
@@ -1,11 +1,65 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, Response, stream_with_context
 from flask_login import login_required, current_user
-from src.models.user import db, Expense, Budget, Category, Family
-from sqlalchemy import func, extract
+from src.models.user import db, Expense, Credit, Budget, Category, CategoryClosure, Family, ArchivedBudgetTotal, FamilyTrendStats
+from src.archive import iter_family_year_records
+from sqlalchemy import select, func, extract, or_, and_, union_all
 import datetime
+import json
 
 reports_bp = Blueprint("reports_bp", __name__)
 
+# Anomaly flags of the monthly listing
+TRAILING_MONTHS = 12 # History an expense is compared against, including its own month
+LARGE_EXPENSE_RANK = 0.95 # Percent rank within the category above which an expense is unusually large
+LARGE_EXPENSE_MIN_SAMPLE = 20 # Categories with fewer expenses in the window are never flagged
+DUPLICATE_WINDOW_DAYS = 7
+
+def _expense_flags(family_id, year, month, budget_id):
+    """Anomaly flags of a month's expenses, keyed by expense id.
+
+    One query: window functions rank each expense against the trailing months of its category
+    and look up its nearest neighbours with the same category and amount.
+    """
+    first_month = year * 12 + month - TRAILING_MONTHS
+    neighbours = dict(partition_by=(Expense.category_id, Expense.amount), order_by=(Expense.expense_date, Expense.id))
+    window = (select(
+        Expense.id,
+        Expense.budget_id,
+        Expense.expense_date,
+        func.percent_rank().over(partition_by=Expense.category_id, order_by=Expense.amount).label("amount_rank"),
+        func.count().over(partition_by=Expense.category_id).label("category_sample"),
+        func.lag(Expense.id).over(**neighbours).label("previous_id"),
+        func.lag(Expense.expense_date, type_=db.Date).over(**neighbours).label("previous_date"),
+        func.lead(Expense.id).over(**neighbours).label("next_id"),
+        func.lead(Expense.expense_date, type_=db.Date).over(**neighbours).label("next_date"))
+        .join(Budget, Budget.id == Expense.budget_id)
+        .where(Budget.family_id == family_id,
+               Budget.year * 12 + Budget.month > first_month,
+               Budget.year * 12 + Budget.month <= year * 12 + month)
+        .subquery())
+
+    flags = {}
+    for row in db.session.execute(select(window).where(window.c.budget_id == budget_id)):
+        duplicate_of = None
+        if row.previous_date and (row.expense_date - row.previous_date).days < DUPLICATE_WINDOW_DAYS:
+            duplicate_of = row.previous_id
+        elif row.next_date and (row.next_date - row.expense_date).days < DUPLICATE_WINDOW_DAYS:
+            duplicate_of = row.next_id
+        flags[row.id] = {
+            "amount_rank": round(float(row.amount_rank), 4),
+            "unusually_large": row.category_sample >= LARGE_EXPENSE_MIN_SAMPLE and row.amount_rank > LARGE_EXPENSE_RANK,
+            "possible_duplicate_of": duplicate_of
+        }
+    return flags
+
+def _total_spent(budget_id):
+    """Spent in a budget month: live expenses plus the totals of archived ones."""
+    live = db.session.query(func.sum(Expense.amount)).filter(Expense.budget_id == budget_id).scalar() or 0
+    archived = (db.session.query(func.sum(ArchivedBudgetTotal.total_amount))
+                .filter(ArchivedBudgetTotal.budget_id == budget_id, ArchivedBudgetTotal.entry_type == "expense")
+                .scalar() or 0)
+    return live + archived
+
 @reports_bp.route("/reports/monthly_expenses", methods=["GET"])
 @login_required
 def get_monthly_expenses():
@@ -25,8 +79,9 @@ def get_monthly_expenses():
         return jsonify({"expenses": [], "total_spent": 0, "planned_budget": 0, "budget_id": None}), 200
 
     expenses = Expense.query.filter_by(budget_id=budget.id).order_by(Expense.expense_date.desc()).all()
+    flags = _expense_flags(family_id, year, month, budget.id)
     
-    total_spent = db.session.query(func.sum(Expense.amount)).filter(Expense.budget_id == budget.id).scalar() or 0
+    total_spent = _total_spent(budget.id) # Archived expenses are not listed but still count
 
     expenses_data = [
         {
@@ -43,7 +98,8 @@ def get_monthly_expenses():
             "created_by": exp.created_by.username if exp.created_by else None,
             "updated_by": exp.updated_by.username if exp.updated_by else None,
             "created_at": exp.created_at.isoformat(),
-            "updated_at": exp.updated_at.isoformat()
+            "updated_at": exp.updated_at.isoformat(),
+            "flags": flags.get(exp.id)
         } for exp in expenses
     ]
     return jsonify({
@@ -59,7 +115,7 @@ def get_expenses_by_category():
     family_id = request.args.get("family_id", type=int)
     year = request.args.get("year", type=int, default=datetime.date.today().year)
     month = request.args.get("month", type=int, default=datetime.date.today().month)
-    category_id = request.args.get("category_id", type=int, default=None) # For subcategory drilldown
+    category_id = request.args.get("category_id", type=int, default=None) # Drilldown into any level of the tree
 
     if not family_id:
         return jsonify({"error": "family_id is required"}), 400
@@ -72,48 +128,31 @@ def get_expenses_by_category():
     if not budget:
         return jsonify([]), 200
 
-    query = db.session.query(
-        Category.id,
-        Category.name,
-        func.sum(Expense.amount).label("total_amount")
-    ).join(Expense, Expense.category_id == Category.id).filter(Expense.budget_id == budget.id)
-    
-    if category_id: # If a parent category is specified, get subcategories
-        query = db.session.query(
-            Category.id,
-            Category.name,
-            func.sum(Expense.amount).label("total_amount")
-        ).join(Expense, Expense.subcategory_id == Category.id).filter(Expense.budget_id == budget.id, Category.parent_id == category_id)
-    else: # Get top-level categories
-        query = db.session.query(
-            Category.id,
-            Category.name,
-            func.sum(Expense.amount).label("total_amount")
-        ).join(Expense, Expense.category_id == Category.id).filter(Expense.budget_id == budget.id, Expense.subcategory_id == None) # Expenses directly under a category
-        
-        # Also include expenses that have subcategories, but sum them under their parent category for the main chart
-        # This part might need refinement based on how exactly the user wants to see parent categories with subcategories summed up.
-        # For simplicity now, the above query focuses on expenses directly linked to a category (no subcategory) or drills down.
-        # A more complex query might be needed if the main category chart should sum up all its subcategories.
-        # Let's refine the top-level category aggregation:
-        query = (db.session.query(
-            Category.id.label("category_id"),
-            Category.name.label("category_name"),
-            func.sum(Expense.amount).label("total_amount")
-        ).select_from(Expense).join(Budget, Expense.budget_id == Budget.id)
-        .join(Category, Expense.category_id == Category.id)
-        .filter(Budget.family_id == family_id, Budget.year == year, Budget.month == month)
-        .group_by(Category.id, Category.name))
-
-    if category_id: # Drilldown for subcategories of the given category_id
-        query = (db.session.query(
-            Category.id.label("subcategory_id"),
-            Category.name.label("subcategory_name"),
-            func.sum(Expense.amount).label("total_amount")
-        ).select_from(Expense).join(Budget, Expense.budget_id == Budget.id)
-        .join(Category, Expense.subcategory_id == Category.id) # Join on subcategory_id
-        .filter(Budget.family_id == family_id, Budget.year == year, Budget.month == month, Expense.category_id == category_id)
-        .group_by(Category.id, Category.name))
+    # An expense sits on its deepest category; the closure table credits it to every ancestor,
+    # so each child's total covers its whole subtree in a single grouped join.
+    if category_id: # Children of the given node, plus expenses booked directly on the node itself
+        level_filter = or_(Category.parent_id == category_id,
+                           and_(Category.id == category_id, CategoryClosure.depth == 0))
+    else: # Top-level categories
+        level_filter = Category.parent_id.is_(None)
+
+    # Live expenses and the per-category totals of archived ones
+    booked = union_all(
+        select(Expense.category_id, Expense.subcategory_id, Expense.amount.label("amount"))
+        .where(Expense.budget_id == budget.id),
+        select(ArchivedBudgetTotal.category_id, ArchivedBudgetTotal.subcategory_id, ArchivedBudgetTotal.total_amount)
+        .where(ArchivedBudgetTotal.budget_id == budget.id, ArchivedBudgetTotal.entry_type == "expense")
+    ).subquery()
+
+    query = (db.session.query(
+        Category.id.label("category_id"),
+        Category.name.label("category_name"),
+        func.sum(booked.c.amount).label("total_amount")
+    ).select_from(booked)
+    .join(CategoryClosure, CategoryClosure.descendant_id == func.coalesce(booked.c.subcategory_id, booked.c.category_id))
+    .join(Category, Category.id == CategoryClosure.ancestor_id)
+    .filter(Category.family_id == family_id, level_filter)
+    .group_by(Category.id, Category.name))
 
     results = query.all()
     data_for_chart = [{"id": r[0], "name": r[1], "value": float(r[2])} for r in results]
@@ -152,7 +191,7 @@ def get_expenses_evolution():
         total_spent = 0
         planned_budget = 0
         if budget:
-            total_spent = db.session.query(func.sum(Expense.amount)).filter(Expense.budget_id == budget.id).scalar() or 0
+            total_spent = _total_spent(budget.id)
             planned_budget = budget.planned_amount
         
         evolution_data.append({
@@ -183,7 +222,7 @@ def get_budget_vs_actual():
     if not budget:
         return jsonify({"planned_budget": 0, "total_spent": 0, "difference": 0}), 200
 
-    total_spent = db.session.query(func.sum(Expense.amount)).filter(Expense.budget_id == budget.id).scalar() or 0
+    total_spent = _total_spent(budget.id)
     planned_amount = budget.planned_amount
     difference = planned_amount - total_spent
 
@@ -206,10 +245,26 @@ def get_historical_summary():
 
     # Query all budgets for the family, ordered by year and month
     budgets = Budget.query.filter_by(family_id=family_id).order_by(Budget.year.desc(), Budget.month.desc()).all()
+
+    # Live rows and archived summaries, each summed per budget in one grouped query
+    family_budget_ids = db.session.query(Budget.id).filter(Budget.family_id == family_id)
+    spent_by_budget = dict(db.session.query(Expense.budget_id, func.sum(Expense.amount))
+                           .filter(Expense.budget_id.in_(family_budget_ids)).group_by(Expense.budget_id).all())
+    credits_by_budget = dict(db.session.query(Credit.budget_id, func.sum(Credit.amount))
+                             .filter(Credit.budget_id.in_(family_budget_ids)).group_by(Credit.budget_id).all())
+    archived_budget_ids = set()
+    for budget_id, entry_type, total in (db.session.query(ArchivedBudgetTotal.budget_id, ArchivedBudgetTotal.entry_type,
+                                                          func.sum(ArchivedBudgetTotal.total_amount))
+                                         .filter(ArchivedBudgetTotal.budget_id.in_(family_budget_ids))
+                                         .group_by(ArchivedBudgetTotal.budget_id, ArchivedBudgetTotal.entry_type)):
+        totals = spent_by_budget if entry_type == "expense" else credits_by_budget
+        totals[budget_id] = (totals.get(budget_id) or 0) + total
+        archived_budget_ids.add(budget_id)
+
     summary = []
     for b in budgets:
-        total_spent = db.session.query(func.sum(Expense.amount)).filter(Expense.budget_id == b.id).scalar() or 0
-        total_credits = db.session.query(func.sum(Credit.amount)).filter(Credit.budget_id == b.id).scalar() or 0 # Assuming Credit model exists
+        total_spent = spent_by_budget.get(b.id) or 0
+        total_credits = credits_by_budget.get(b.id) or 0
         summary.append({
             "budget_id": b.id,
             "year": b.year,
@@ -217,7 +272,48 @@ def get_historical_summary():
             "planned_amount": float(b.planned_amount),
             "total_spent": float(total_spent),
             "total_credits": float(total_credits),
-            "balance": float(b.planned_amount + total_credits - total_spent)
+            "balance": float(b.planned_amount + total_credits - total_spent),
+            "archived": b.id in archived_budget_ids
         })
     return jsonify(summary), 200
 
+def _json_default(value):
+    return value.isoformat() if hasattr(value, "isoformat") else str(value)
+
+@reports_bp.route("/reports/export", methods=["GET"])
+@login_required
+def export_year():
+    family_id = request.args.get("family_id", type=int)
+    year = request.args.get("year", type=int)
+    if not family_id or not year:
+        return jsonify({"error": "family_id and year are required"}), 400
+
+    family = Family.query.get(family_id)
+    if not family or current_user not in family.members:
+        return jsonify({"error": "User not authorized for this family or family not found"}), 403
+
+    # Archived years are read from their blob, recent ones from the live tables
+    def generate():
+        for entry_type, row in iter_family_year_records(family_id, year):
+            yield json.dumps({"type": entry_type, **row}, default=_json_default, separators=(",", ":")) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson", headers={
+        "Content-Disposition": f"attachment; filename=family_{family_id}_{year}.jsonl"
+    })
+
+@reports_bp.route("/reports/trends", methods=["GET"])
+@login_required
+def get_trends():
+    family_id = request.args.get("family_id", type=int)
+    if not family_id:
+        return jsonify({"error": "family_id is required"}), 400
+
+    family = Family.query.get(family_id)
+    if not family or current_user not in family.members:
+        return jsonify({"error": "User not authorized for this family or family not found"}), 403
+
+    # Precomputed nightly by `flask rollup-trends`
+    stats = db.session.get(FamilyTrendStats, family_id)
+    if not stats:
+        return jsonify({"computed_at": None, "trends": None}), 200
+    return jsonify({"computed_at": stats.computed_at.isoformat(), "trends": stats.data}), 200
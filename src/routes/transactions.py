@@ -1,12 +1,81 @@
 from flask import Blueprint, request, jsonify
 from flask_login import login_required, current_user
-from src.models.user import db, Expense, Credit, Budget, Category, PaymentType, Family
+from src.models.user import (db, Expense, Credit, Budget, Category, CategoryClosure, PaymentType, Family, ChangeLog,
+                             ExpenseAttachment, ConcurrentChange, json_object)
+from src.events import broadcaster
+from src.idempotency import idempotent
+from sqlalchemy import select, case, func, literal, null, ColumnElement
 import datetime
 
 expense_bp = Blueprint("expense_bp", __name__)
 
+def _publish_budget_update(budget, entity, action, ids, spent_delta=0, credit_delta=0, category_deltas=None):
+    """Push a compact update to the family's open dashboards once the transaction commits."""
+    broadcaster.publish_after_commit(budget.family_id, {
+        "entity": entity,
+        "action": action,
+        "ids": ids,
+        "budget_id": budget.id,
+        "year": budget.year,
+        "month": budget.month,
+        "spent_delta": float(spent_delta),
+        "credit_delta": float(credit_delta),
+        "categories": {str(category_id): float(delta) for category_id, delta in (category_deltas or {}).items() if delta}
+    })
+
+def _publish_bulk_expense_update(action, totals, new_category_id=None):
+    """Publish one update per budget touched by a bulk operation.
+
+    totals are (budget_id, category_id, amount) sums of the affected rows taken before the change.
+    The events carry no ids; clients fetch the changed rows through /api/changes.
+    """
+    per_budget = {}
+    for budget_id, category_id, amount in totals:
+        deltas = per_budget.setdefault(budget_id, {"spent": 0, "categories": {}})
+        categories = deltas["categories"]
+        if action == "bulk_delete":
+            deltas["spent"] -= amount
+            categories[category_id] = categories.get(category_id, 0) - amount
+        elif new_category_id is not None and category_id != new_category_id:
+            categories[category_id] = categories.get(category_id, 0) - amount
+            categories[new_category_id] = categories.get(new_category_id, 0) + amount
+
+    for budget in Budget.query.filter(Budget.id.in_(per_budget.keys())):
+        deltas = per_budget[budget.id]
+        _publish_budget_update(budget, "expense", action, None, spent_delta=deltas["spent"],
+                               category_deltas=deltas["categories"])
+
+def _expense_totals(criteria):
+    return db.session.execute(
+        select(Expense.budget_id, Expense.category_id, func.sum(Expense.amount))
+        .where(*criteria)
+        .group_by(Expense.budget_id, Expense.category_id)
+    ).all()
+
+def _expense_change_data(values, updated_at):
+    """JSON of Expense.to_dict() computed in SQL, with values applied on top of the current row."""
+    def column(attribute):
+        if attribute not in values:
+            return attribute
+        value = values[attribute]
+        return value if isinstance(value, ColumnElement) else literal(value) if value is not None else null()
+    return json_object({
+        "id": Expense.id,
+        "budget_id": Expense.budget_id,
+        "category_id": column(Expense.category_id),
+        "subcategory_id": column(Expense.subcategory_id),
+        "payment_type_id": column(Expense.payment_type_id),
+        "description": column(Expense.description),
+        "amount": Expense.amount,
+        "expense_date": Expense.expense_date,
+        "created_by_user_id": Expense.created_by_user_id,
+        "updated_by_user_id": column(Expense.updated_by_user_id),
+        "updated_at": literal(updated_at.isoformat())
+    })
+
 @expense_bp.route("/expense", methods=["POST"])
 @login_required
+@idempotent
 def add_expense():
     data = request.get_json()
     try:
@@ -21,17 +90,8 @@ def add_expense():
         if not family or current_user not in family.members:
             return jsonify({"error": "User not authorized for this family or family not found"}), 403
 
-        # Find or create budget for the month
-        budget = Budget.query.filter_by(family_id=data["family_id"], year=data["year"], month=data["month"]).first()
-        if not budget:
-            budget = Budget(
-                family_id=data["family_id"],
-                year=data["year"],
-                month=data["month"],
-                planned_amount=0 # Default planned amount, can be set elsewhere
-            )
-            db.session.add(budget)
-            # db.session.commit() # Commit later with expense
+        # Find or create budget for the month (safe against concurrent first writes)
+        budget = Budget.find_or_create(data["family_id"], data["year"], data["month"])
 
         # Validate category
         category = Category.query.filter_by(id=data["category_id"], family_id=data["family_id"]).first()
@@ -41,9 +101,9 @@ def add_expense():
         # Validate subcategory if provided
         subcategory_id = data.get("subcategory_id")
         if subcategory_id:
-            subcategory = Category.query.filter_by(id=subcategory_id, family_id=data["family_id"], parent_id=data["category_id"]).first()
+            subcategory = Category.find_descendant(data["family_id"], data["category_id"], subcategory_id)
             if not subcategory:
-                return jsonify({"error": "Subcategory not found, does not belong to this family, or is not a child of the selected category"}), 400
+                return jsonify({"error": "Subcategory not found, does not belong to this family, or is not below the selected category"}), 400
         
         # Validate payment type
         payment_type = PaymentType.query.filter_by(id=data["payment_type_id"], family_id=data["family_id"]).first()
@@ -51,7 +111,7 @@ def add_expense():
             return jsonify({"error": "Payment type not found or does not belong to this family"}), 400
 
         new_expense = Expense(
-            budget_id=budget.id, # Will be set after budget is committed if new
+            budget_id=budget.id,
             category_id=data["category_id"],
             subcategory_id=data.get("subcategory_id"),
             payment_type_id=data["payment_type_id"],
@@ -62,6 +122,10 @@ def add_expense():
             updated_by_user_id=current_user.id
         )
         db.session.add(new_expense)
+        db.session.flush()
+        ChangeLog.record(family.id, "expense", new_expense.id, "create", new_expense.to_dict(), current_user.id)
+        _publish_budget_update(budget, "expense", "create", [new_expense.id], spent_delta=new_expense.amount,
+                               category_deltas={new_expense.category_id: new_expense.amount})
         db.session.commit()
         return jsonify({"message": "Expense added successfully", "expense_id": new_expense.id}), 201
 
@@ -82,6 +146,8 @@ def update_expense(expense_id):
     if not family or current_user not in family.members:
         return jsonify({"error": "User not authorized to update this expense"}), 403
 
+    old_amount = expense.amount
+    old_category_id = expense.category_id
     try:
         if "category_id" in data:
             category = Category.query.filter_by(id=data["category_id"], family_id=family.id).first()
@@ -93,14 +159,13 @@ def update_expense(expense_id):
             if data["subcategory_id"] is None:
                 expense.subcategory_id = None
             else:
-                subcategory = Category.query.filter_by(id=data["subcategory_id"], family_id=family.id, parent_id=expense.category_id).first()
+                subcategory = Category.find_descendant(family.id, expense.category_id, data["subcategory_id"])
                 if not subcategory:
-                    return jsonify({"error": "Subcategory not found, does not belong to this family, or is not a child of the selected category"}), 400
+                    return jsonify({"error": "Subcategory not found, does not belong to this family, or is not below the selected category"}), 400
                 expense.subcategory_id = data["subcategory_id"]
         elif "category_id" in data and expense.subcategory_id is not None: # if category changed, subcategory might be invalid
              # Check if current subcategory is still valid for the new category
-            current_subcategory = Category.query.get(expense.subcategory_id)
-            if current_subcategory and current_subcategory.parent_id != expense.category_id:
+            if not Category.find_descendant(family.id, expense.category_id, expense.subcategory_id):
                 expense.subcategory_id = None # or return error, or ask user to re-select
 
         if "payment_type_id" in data:
@@ -118,6 +183,12 @@ def update_expense(expense_id):
         
         expense.updated_at = datetime.datetime.utcnow()
         expense.updated_by_user_id = current_user.id
+        ChangeLog.record(family.id, "expense", expense.id, "update", expense.to_dict(), current_user.id)
+        new_amount = float(expense.amount)
+        category_deltas = {old_category_id: -float(old_amount)}
+        category_deltas[expense.category_id] = category_deltas.get(expense.category_id, 0) + new_amount
+        _publish_budget_update(budget, "expense", "update", [expense.id], spent_delta=new_amount - float(old_amount),
+                               category_deltas=category_deltas)
         
         db.session.commit()
         return jsonify({"message": "Expense updated successfully", "expense_id": expense.id}), 200
@@ -140,6 +211,11 @@ def delete_expense(expense_id):
         return jsonify({"error": "User not authorized to delete this expense"}), 403
     
     try:
+        ChangeLog.record(family.id, "expense", expense.id, "delete", None, current_user.id)
+        _publish_budget_update(budget, "expense", "delete", [expense.id], spent_delta=-expense.amount,
+                               category_deltas={expense.category_id: -expense.amount})
+        # Receipt files are left to the nightly sweep, they may be shared with other attachments
+        ExpenseAttachment.query.filter_by(expense_id=expense.id).delete(synchronize_session=False)
         db.session.delete(expense)
         db.session.commit()
         return jsonify({"message": "Expense deleted successfully"}), 200
@@ -147,10 +223,170 @@ def delete_expense(expense_id):
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
 
+def _bulk_expense_filters(data):
+    """Translate a bulk request filter into SQL criteria on Expense.
+
+    Returns (criteria, error_message). The family filter is always applied so a bulk
+    operation can never reach rows of another family.
+    """
+    family_id = data["family_id"]
+    criteria = [Expense.budget_id.in_(select(Budget.id).where(Budget.family_id == family_id))]
+    filters = data.get("filter") or {}
+
+    if "ids" in filters:
+        if not isinstance(filters["ids"], list) or not filters["ids"]:
+            return None, "filter.ids must be a non-empty list"
+        criteria.append(Expense.id.in_(filters["ids"]))
+    if "start_date" in filters:
+        criteria.append(Expense.expense_date >= datetime.datetime.strptime(filters["start_date"], "%Y-%m-%d").date())
+    if "end_date" in filters:
+        criteria.append(Expense.expense_date <= datetime.datetime.strptime(filters["end_date"], "%Y-%m-%d").date())
+    if "category_id" in filters:
+        criteria.append(Expense.category_id == filters["category_id"])
+    if "subcategory_id" in filters:
+        criteria.append(Expense.subcategory_id == filters["subcategory_id"])
+    if "payment_type_id" in filters:
+        criteria.append(Expense.payment_type_id == filters["payment_type_id"])
+    if "description" in filters:
+        criteria.append(Expense.description.ilike(f"%{filters['description']}%"))
+
+    if len(criteria) == 1:
+        return None, "At least one filter is required"
+    return criteria, None
+
+@expense_bp.route("/expense/bulk_update", methods=["POST"])
+@login_required
+def bulk_update_expenses():
+    data = request.get_json()
+    try:
+        for field in ["family_id", "filter", "changes"]:
+            if field not in data:
+                return jsonify({"error": f"Missing required field: {field}"}), 400
+
+        family = Family.query.get(data["family_id"])
+        if not family or current_user not in family.members:
+            return jsonify({"error": "User not authorized for this family or family not found"}), 403
+
+        criteria, error = _bulk_expense_filters(data)
+        if error:
+            return jsonify({"error": error}), 400
+
+        changes = data["changes"]
+        values = {}
+
+        # Validate the patch once, not per row
+        if "category_id" in changes:
+            category = Category.query.filter_by(id=changes["category_id"], family_id=family.id).first()
+            if not category:
+                return jsonify({"error": "Category not found or does not belong to this family"}), 400
+            values[Expense.category_id] = changes["category_id"]
+
+        if "subcategory_id" in changes:
+            if changes["subcategory_id"] is None:
+                values[Expense.subcategory_id] = None
+            else:
+                if "category_id" not in changes:
+                    return jsonify({"error": "category_id is required when setting subcategory_id in bulk"}), 400
+                subcategory = Category.find_descendant(family.id, changes["category_id"], changes["subcategory_id"])
+                if not subcategory:
+                    return jsonify({"error": "Subcategory not found, does not belong to this family, or is not below the selected category"}), 400
+                values[Expense.subcategory_id] = changes["subcategory_id"]
+        elif "category_id" in changes:
+            # Keep subcategories that are still below the new category, clear the rest
+            values[Expense.subcategory_id] = case(
+                (Expense.subcategory_id.in_(
+                    select(CategoryClosure.descendant_id).where(CategoryClosure.ancestor_id == changes["category_id"],
+                                                                CategoryClosure.depth > 0)
+                ), Expense.subcategory_id),
+                else_=None
+            )
+
+        if "payment_type_id" in changes:
+            payment_type = PaymentType.query.filter_by(id=changes["payment_type_id"], family_id=family.id).first()
+            if not payment_type:
+                return jsonify({"error": "Payment type not found or does not belong to this family"}), 400
+            values[Expense.payment_type_id] = changes["payment_type_id"]
+
+        if "description" in changes:
+            values[Expense.description] = changes["description"]
+
+        if not values:
+            return jsonify({"error": "No supported fields to update"}), 400
+
+        now = datetime.datetime.utcnow()
+        values[Expense.updated_at] = now
+        values[Expense.updated_by_user_id] = current_user.id
+
+        # Set-based throughout: the change log is written from the rows with the new values
+        # applied in SQL, then one UPDATE by the same criteria must hit exactly those rows
+        totals = _expense_totals(criteria)
+        logged = ChangeLog.record_from_select(
+            family.id, "expense", "update",
+            select(Expense.id.label("entity_id"), _expense_change_data(values, now).label("data")).where(*criteria),
+            current_user.id)
+        updated_count = db.session.query(Expense).filter(*criteria).update(values, synchronize_session=False)
+        if updated_count != logged:
+            raise ConcurrentChange("Expenses changed while they were being updated")
+        if updated_count:
+            _publish_bulk_expense_update("bulk_update", totals, changes.get("category_id"))
+        db.session.commit()
+        return jsonify({"message": "Expenses updated successfully", "updated_count": updated_count}), 200
+
+    except ConcurrentChange as e:
+        db.session.rollback()
+        return jsonify({"error": f"{e}, retry the request"}), 409
+    except ValueError as ve:
+        return jsonify({"error": f"Invalid data format: {str(ve)}"}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500
+
+@expense_bp.route("/expense/bulk_delete", methods=["POST"])
+@login_required
+def bulk_delete_expenses():
+    data = request.get_json()
+    try:
+        for field in ["family_id", "filter"]:
+            if field not in data:
+                return jsonify({"error": f"Missing required field: {field}"}), 400
+
+        family = Family.query.get(data["family_id"])
+        if not family or current_user not in family.members:
+            return jsonify({"error": "User not authorized for this family or family not found"}), 403
+
+        criteria, error = _bulk_expense_filters(data)
+        if error:
+            return jsonify({"error": error}), 400
+
+        totals = _expense_totals(criteria)
+        logged = ChangeLog.record_from_select(
+            family.id, "expense", "delete",
+            select(Expense.id.label("entity_id"), null().label("data")).where(*criteria), current_user.id)
+        (db.session.query(ExpenseAttachment)
+         .filter(ExpenseAttachment.expense_id.in_(select(Expense.id).where(*criteria)))
+         .delete(synchronize_session=False))
+        deleted_count = db.session.query(Expense).filter(*criteria).delete(synchronize_session=False)
+        if deleted_count != logged:
+            raise ConcurrentChange("Expenses changed while they were being deleted")
+        if deleted_count:
+            _publish_bulk_expense_update("bulk_delete", totals)
+        db.session.commit()
+        return jsonify({"message": "Expenses deleted successfully", "deleted_count": deleted_count}), 200
+
+    except ConcurrentChange as e:
+        db.session.rollback()
+        return jsonify({"error": f"{e}, retry the request"}), 409
+    except ValueError as ve:
+        return jsonify({"error": f"Invalid data format: {str(ve)}"}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500
+
 credit_bp = Blueprint("credit_bp", __name__)
 
 @credit_bp.route("/credit", methods=["POST"])
 @login_required
+@idempotent
 def add_credit():
     data = request.get_json()
     try:
@@ -163,15 +399,7 @@ def add_credit():
         if not family or current_user not in family.members:
             return jsonify({"error": "User not authorized for this family or family not found"}), 403
 
-        budget = Budget.query.filter_by(family_id=data["family_id"], year=data["year"], month=data["month"]).first()
-        if not budget:
-            budget = Budget(
-                family_id=data["family_id"],
-                year=data["year"],
-                month=data["month"],
-                planned_amount=0 
-            )
-            db.session.add(budget)
+        budget = Budget.find_or_create(data["family_id"], data["year"], data["month"])
 
         new_credit = Credit(
             budget_id=budget.id,
@@ -182,6 +410,9 @@ def add_credit():
             updated_by_user_id=current_user.id
         )
         db.session.add(new_credit)
+        db.session.flush()
+        ChangeLog.record(family.id, "credit", new_credit.id, "create", new_credit.to_dict(), current_user.id)
+        _publish_budget_update(budget, "credit", "create", [new_credit.id], credit_delta=new_credit.amount)
         db.session.commit()
         return jsonify({"message": "Credit added successfully", "credit_id": new_credit.id}), 201
 
@@ -202,6 +433,7 @@ def update_credit(credit_id):
     if not family or current_user not in family.members:
         return jsonify({"error": "User not authorized to update this credit"}), 403
 
+    old_amount = credit.amount
     try:
         if "description" in data:
             credit.description = data["description"]
@@ -212,6 +444,8 @@ def update_credit(credit_id):
         
         credit.updated_at = datetime.datetime.utcnow()
         credit.updated_by_user_id = current_user.id
+        ChangeLog.record(family.id, "credit", credit.id, "update", credit.to_dict(), current_user.id)
+        _publish_budget_update(budget, "credit", "update", [credit.id], credit_delta=float(credit.amount) - float(old_amount))
         
         db.session.commit()
         return jsonify({"message": "Credit updated successfully", "credit_id": credit.id}), 200
@@ -233,6 +467,8 @@ def delete_credit(credit_id):
         return jsonify({"error": "User not authorized to delete this credit"}), 403
     
     try:
+        ChangeLog.record(family.id, "credit", credit.id, "delete", None, current_user.id)
+        _publish_budget_update(budget, "credit", "delete", [credit.id], credit_delta=-credit.amount)
         db.session.delete(credit)
         db.session.commit()
         return jsonify({"message": "Credit deleted successfully"}), 200
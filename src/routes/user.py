@@ -1,8 +1,69 @@
-from flask import Blueprint, jsonify, request
-from src.models.user import User, db
+from flask import Blueprint, jsonify, request, current_app
+from flask_login import login_user, logout_user, login_required, current_user
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
+from sqlalchemy import select, func, and_
+from src.models.user import User, Family, Budget, Expense, ChangeLog, ChangeSequence, family_members, db
+import datetime
+import threading
+import time
 
 user_bp = Blueprint('user', __name__)
 
+# Seconds a user's family listing is served from memory; it is requested on every page load
+FAMILIES_CACHE_TTL = 30
+_families_cache = {}
+_families_cache_lock = threading.Lock()
+_families_cache_pruned_at = 0.0
+
+# Bearer tokens sent by the frontend (localStorage 'authToken') stay valid this long
+AUTH_TOKEN_MAX_AGE = 7 * 24 * 3600
+
+def _token_serializer():
+    return URLSafeTimedSerializer(current_app.config['SECRET_KEY'], salt='auth-token')
+
+def make_auth_token(user):
+    return _token_serializer().dumps(user.id)
+
+def load_user_from_token(token):
+    try:
+        user_id = _token_serializer().loads(token, max_age=AUTH_TOKEN_MAX_AGE)
+    except (BadSignature, SignatureExpired):
+        return None
+    return db.session.get(User, user_id)
+
+def _user_dict(user):
+    return {'id': user.id, 'username': user.username, 'email': user.email}
+
+@user_bp.route('/register', methods=['POST'])
+def register():
+    data = request.get_json()
+    for field in ['username', 'email', 'password']:
+        if not data.get(field):
+            return jsonify({'error': f'Missing required field: {field}'}), 400
+    if User.query.filter((User.username == data['username']) | (User.email == data['email'])).first():
+        return jsonify({'error': 'Username or email already registered'}), 400
+
+    user = User(username=data['username'], email=data['email'])
+    user.set_password(data['password'])
+    db.session.add(user)
+    db.session.commit()
+    return jsonify({'message': 'User registered successfully.', 'user': _user_dict(user)}), 201
+
+@user_bp.route('/login', methods=['POST'])
+def login():
+    data = request.get_json()
+    user = User.query.filter_by(email=data.get('email')).first()
+    if not user or not user.check_password(data.get('password', '')):
+        return jsonify({'error': 'Invalid email or password'}), 401
+
+    login_user(user)
+    return jsonify({'access_token': make_auth_token(user), 'user': _user_dict(user)}), 200
+
+@user_bp.route('/logout', methods=['POST'])
+def logout():
+    logout_user()
+    return '', 204
+
 @user_bp.route('/users', methods=['GET'])
 def get_users():
     users = User.query.all()
@@ -37,3 +98,64 @@ def delete_user(user_id):
     db.session.delete(user)
     db.session.commit()
     return '', 204
+
+def _family_summaries(user_id):
+    """Every family of the user with role, member count, this month's spend vs. plan and last activity, in one query."""
+    today = datetime.date.today()
+    # Correlated subqueries so each figure is an index lookup on the user's few families,
+    # never an aggregate over the whole expense or membership table
+    member_count = (select(func.count()).select_from(family_members)
+                    .where(family_members.c.family_id == Family.id).correlate(Family).scalar_subquery())
+    spent = (select(func.sum(Expense.amount)).where(Expense.budget_id == Budget.id)
+             .correlate(Budget).scalar_subquery())
+    last_seq = (select(ChangeSequence.last_seq).where(ChangeSequence.family_id == Family.id)
+                .correlate(Family).scalar_subquery())
+    last_activity = (select(ChangeLog.created_at).where(ChangeLog.family_id == Family.id, ChangeLog.seq == last_seq)
+                     .correlate(Family).scalar_subquery())
+
+    query = (select(Family.id, Family.name, family_members.c.role, member_count.label('member_count'),
+                    Budget.planned_amount, spent.label('spent'), last_activity.label('last_activity'))
+             .join(family_members, family_members.c.family_id == Family.id)
+             .outerjoin(Budget, and_(Budget.family_id == Family.id, Budget.year == today.year, Budget.month == today.month))
+             .where(family_members.c.user_id == user_id)
+             .order_by(Family.name))
+
+    return [{
+        'id': row.id,
+        'name': row.name,
+        'role': row.role,
+        'member_count': row.member_count,
+        'current_month': {'year': today.year, 'month': today.month,
+                          'planned_amount': float(row.planned_amount or 0), 'total_spent': float(row.spent or 0)},
+        'last_activity': row.last_activity.isoformat() if row.last_activity else None
+    } for row in db.session.execute(query)]
+
+def _prune_families_cache(now):
+    """Drop expired listings, at most once per TTL so the sweep stays cheap; call with the lock held."""
+    global _families_cache_pruned_at
+    if now - _families_cache_pruned_at < FAMILIES_CACHE_TTL:
+        return
+    _families_cache_pruned_at = now
+    for user_id in [user_id for user_id, (expires_at, _) in _families_cache.items() if expires_at <= now]:
+        del _families_cache[user_id]
+
+@user_bp.route('/user/<int:user_id>/families', methods=['GET'])
+@login_required
+def get_user_families(user_id):
+    if current_user.id != user_id:
+        return jsonify({'error': 'User not authorized to list these families'}), 403
+
+    now = time.monotonic()
+    with _families_cache_lock:
+        cached = _families_cache.get(user_id)
+    if cached and cached[0] > now:
+        families = cached[1]
+    else:
+        families = _family_summaries(user_id)
+        with _families_cache_lock:
+            _families_cache[user_id] = (now + FAMILIES_CACHE_TTL, families)
+            _prune_families_cache(now)
+
+    response = jsonify(families)
+    response.headers['Cache-Control'] = f'private, max-age={FAMILIES_CACHE_TTL}'
+    return response, 200